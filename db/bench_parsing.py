@@ -0,0 +1,116 @@
+"""Сколько времени занимает разбор сохранённых страниц из db/pages каждым установленным парсером.
+
+Для страницы с оценками ещё сравнивается обход таблицы за один проход с прежним обходом по каждой части года.
+
+Нужен установленный пакет (pip install -e .), запуск: python db/bench_parsing.py [-n повторов]
+"""
+import argparse
+import pathlib
+import time
+
+from bs4 import BeautifulSoup
+
+from elschool_bot.parsing import (GRADES_TABLE, DataProcessError, available_parsers, parse_diaries, parse_grades,
+                                  parse_results)
+
+PAGES = pathlib.Path(__file__).parent / 'pages'
+
+BENCHMARKS = {
+    'оценки': ('grades.html', lambda text, parser: parse_grades(text, parser)),
+    'итоговые оценки': ('results.html', lambda text, parser: parse_results(text, parser)),
+    'дневник': ('diaries.html', lambda text, parser: parse_diaries(text, 2024, 3, parser)),
+}
+
+
+def parse_grades_per_quarter(text, parser):
+    """parse_grades до обхода за один проход: строки таблицы заново перебираются для каждой части года."""
+    try:
+        bs = BeautifulSoup(text, parser, parse_only=GRADES_TABLE)
+        table = bs.find('table', class_='GradesTable')
+        if not table:
+            raise DataProcessError('на странице не найдена таблица с оценками')
+        thead = table.find('thead')
+        if not thead:
+            raise DataProcessError('на странице не найден блок для заголовков')
+        ths = thead.find_all('th')
+        if not ths:
+            raise DataProcessError('на странице не найдены заголовки с названиями частей года')
+        quarters = [th.text.strip() for th in ths if not th.attrs]
+        grades = {}
+
+        for i in range(len(quarters)):
+            quarter_grades = {}
+            tbody = table.find('tbody')
+            if not tbody:
+                raise DataProcessError('на странице не найдено тело таблицы')
+            trs = tbody.find_all('tr')
+            if not trs:
+                raise DataProcessError('в таблице нет строк с уроками')
+            for tr in trs:
+                td = tr.find('td', class_='grades-lesson')
+                if not td:
+                    raise DataProcessError('в строке таблицы нет названия урока')
+                lesson_name = td.text.strip()
+                lesson_marks = []
+                tds = tr.find_all('td', class_='grades-marks')
+                if not tds:
+                    raise DataProcessError('в строке таблицы нет частей года')
+                if i >= len(tds):
+                    raise DataProcessError('выбранной части года нет в строке таблицы')
+                marks = tds[i]
+
+                for mark in marks.find_all('span', class_='mark-span'):
+                    lesson_date, date = mark['data-popover-content'].split('<p>')
+                    lesson_marks.append({
+                        'lesson_date': lesson_date.split(':')[1].strip(),
+                        'date': date.split(':')[1].strip(),
+                        'mark': int(mark.text)
+                    })
+
+                quarter_grades[lesson_name] = lesson_marks
+            grades[quarters[i]] = quarter_grades
+    except Exception as e:
+        raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
+    return grades
+
+
+def measure(function, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        function()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def compare_grades_walk(n):
+    text = (PAGES / 'grades.html').read_text(encoding='utf-8')
+    for parser in available_parsers():
+        if parse_grades_per_quarter(text, parser) != parse_grades(text, parser):
+            print(f'оценки, {parser}: обходы разобрали страницу по-разному')
+            continue
+        # построение дерева у обоих обходов одинаковое, разница только в обходе
+        soup = measure(lambda: BeautifulSoup(text, parser, parse_only=GRADES_TABLE), n)
+        old = measure(lambda: parse_grades_per_quarter(text, parser), n) - soup
+        new = measure(lambda: parse_grades(text, parser), n) - soup
+        print(f'оценки, {parser}: построение дерева {soup:.2f} мс, обход по частям года {old:.2f} мс, '
+              f'обход за один проход {new:.2f} мс')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('-n', type=int, default=50, help='сколько раз разбирать каждую страницу')
+    args = arg_parser.parse_args()
+
+    for name, (page, parse) in BENCHMARKS.items():
+        text = (PAGES / page).read_text(encoding='utf-8')
+        results = {}
+        for parser in available_parsers():
+            results[parser] = parse(text, parser)
+            elapsed = measure(lambda: parse(text, parser), args.n)
+            print(f'{name}, {parser}: {elapsed:.2f} мс')
+        if len(set(map(repr, results.values()))) > 1:
+            print(f'{name}: парсеры разобрали страницу по-разному')
+    compare_grades_walk(args.n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Ищет запросы Repo, план которых содержит полный проход по таблице.
+
+Нужен установленный пакет (pip install -e .), запуск: python db/check_query_plans.py [файл базы данных].
+Без файла проверяется пустая база, созданная всеми миграциями.
+"""
+import argparse
+import ast
+import asyncio
+import inspect
+import os
+import re
+import sqlite3
+import tempfile
+
+from elschool_bot import DatabaseConfig, repository
+from elschool_bot.migrations import Migrator
+
+QUERY_METHODS = ('execute', 'executemany', 'execute_fetchall')
+
+# полные проходы, которые нужны: запросы читают все строки таблицы
+KNOWN_SCANS = {
+    # при запуске восстанавливаются все отправки
+    'SELECT user_id, id, next_time, interval, next_run, run_day FROM schedules',
+    'SELECT id, -1, autosend_schedule_time, autosend_schedule_interval, autosend_schedule_next_run, '
+    'autosend_schedule_run_day FROM users WHERE autosend_schedule_time IS NOT NULL',
+}
+
+
+def repository_queries():
+    """Все SQL запросы, которые передаются в execute, executemany и execute_fetchall внутри модуля repository.
+    Подстановки в f-строках вычисляются со значениями из модуля, например список столбцов USER_COLUMNS."""
+    queries = []
+    for node in ast.walk(ast.parse(inspect.getsource(repository))):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+            continue
+        if node.func.attr not in QUERY_METHODS or not node.args:
+            continue
+        query = node.args[0]
+        if isinstance(query, ast.JoinedStr):
+            query = ast.Constant(eval(compile(ast.Expression(query), '<query>', 'eval'), vars(repository)))
+        if isinstance(query, ast.Constant) and isinstance(query.value, str) and query.value not in queries:
+            queries.append(query.value)
+    return queries
+
+
+def query_parameters(query):
+    names = re.findall(r':(\w+)', query)
+    if names:
+        return dict.fromkeys(names)
+    return [None] * query.count('?')
+
+
+def find_scans(connection: sqlite3.Connection, queries):
+    """Возвращает запросы, план которых содержит полный проход по таблице (SCAN), вместе с этими шагами плана."""
+    scans = {}
+    for query in queries:
+        try:
+            plan = connection.execute(f'EXPLAIN QUERY PLAN {query}', query_parameters(query)).fetchall()
+        except sqlite3.Error as e:
+            scans[query] = [f'не удалось получить план: {e}']
+            continue
+        # json_each перебирает переданный в запрос список, а не таблицу
+        steps = [detail for *_, detail in plan
+                 if detail.startswith('SCAN') and detail != 'SCAN CONSTANT ROW' and 'VIRTUAL TABLE' not in detail]
+        if steps:
+            scans[query] = steps
+    return scans
+
+
+def print_scans(dbfile):
+    db = sqlite3.connect(dbfile)
+    try:
+        scans = find_scans(db, repository_queries())
+    finally:
+        db.close()
+    unexpected = 0
+    for query, steps in scans.items():
+        known = query in KNOWN_SCANS
+        unexpected += not known
+        print(query + (' (нужен полный проход)' if known else ''))
+        for step in steps:
+            print('    ', step)
+    print(f'запросов с полным проходом по таблице: {len(scans)}, из них неожиданных: {unexpected}')
+    return unexpected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('dbfile', nargs='?', help='файл базы данных бота')
+    args = parser.parse_args()
+
+    if args.dbfile is not None:
+        return print_scans(args.dbfile)
+    # Migrator открывает базу сам, поэтому вместо :memory: используется временный файл
+    with tempfile.TemporaryDirectory() as directory:
+        dbfile = os.path.join(directory, 'bot.db')
+        asyncio.run(Migrator(dbfile, DatabaseConfig()).migrate())
+        return print_scans(dbfile)
+
+
+if __name__ == '__main__':
+    raise SystemExit(1 if main() else 0)
@@ -1,10 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
 class BotConfig:
     token: str
     parse_mode: str
+    # id пользователей telegram, которым доступны команды разработчика, например /stats.
+    # При запуске берутся из переменной окружения ADMIN_IDS через запятую
+    admin_ids: tuple = ()
 
 
 @dataclass
@@ -13,12 +16,113 @@ class LoggingConfig:
     format: str
 
 
+@dataclass
+class ElschoolConfig:
+    limit: int = 100
+    limit_per_host: int = 30
+    keepalive_timeout: float = 60
+    dns_cache_ttl: int = 600
+    # запросов в секунду ко всему elschool, None значит без ограничения
+    rate_limit: float = 10
+    rate_burst: int = 20
+    max_concurrency: int = 10
+    # время на одну попытку запроса и на все попытки вместе с паузами между ними, в секундах
+    request_timeout: float = 15
+    operation_timeout: float = 60
+    # сколько раз повторять GET запрос после временной ошибки
+    retries: int = 3
+    retry_backoff: float = 0.5
+    retry_backoff_max: float = 8
+    # после скольких ошибок подряд запросы к elschool останавливаются и через сколько секунд пробуются снова
+    breaker_failures: int = 5
+    breaker_reset_timeout: float = 30
+    # None значит html.parser. 'lxml' быстрее, но его нужно установить отдельно
+    html_parser: str = None
+    # где разбираются страницы: 'process' - в отдельных процессах, 'thread' - в потоках,
+    # None - прямо в цикле событий
+    parse_executor: str = 'process'
+    # None значит по количеству процессоров
+    parse_workers: int = None
+
+
+@dataclass
+class TelegramConfig:
+    # запросов в секунду ко всем чатам и к одному чату. Telegram разрешает примерно 30 и 1
+    rate: float = 25
+    burst: int = 5
+    chat_rate: float = 1
+    chat_burst: int = 3
+    # сколько раз повторять запрос, на который telegram ответил ошибкой 429
+    retries: int = 3
+
+
+@dataclass
+class DatabaseConfig:
+    pool_size: int = 5
+    journal_mode: str = 'WAL'
+    synchronous: str = 'NORMAL'
+    # как в sqlite: отрицательное значение это размер в килобайтах, положительное в страницах
+    cache_size: int = -16000
+    mmap_size: int = 64 * 1024 * 1024
+    temp_store: str = 'MEMORY'
+    foreign_keys: bool = True
+    backfill_batch_size: int = 500
+    backfill_pause: float = 0.1
+
+
+@dataclass
+class CacheConfig:
+    # сколько пользователей и чьих оценок держать в памяти и сколько секунд
+    users: int = 10000
+    grades: int = 2000
+    ttl: float = 600
+
+
+@dataclass
+class NotificationsConfig:
+    # отправка, пропущенная, пока бот не работал, выполняется после запуска, если опоздала не больше, чем на столько секунд.
+    # Из нескольких пропущенных повторений выполняется только последнее
+    misfire_grace_time: float = 60 * 60
+
+
+@dataclass
+class MonitoringConfig:
+    loop_lag_interval: float = 0.5
+    # задержки цикла событий больше этой пишутся в лог
+    loop_lag_warning: float = 0.1
+
+
+@dataclass
+class PrefetchConfig:
+    enabled: bool = True
+    # как часто искать кеш, который скоро устареет, и за сколько секунд до этого его обновлять
+    interval: float = 30
+    ahead: float = 120
+    # за сколько секунд до отправок по времени обновлять кеш тех, кому они придут.
+    # Обновления идут по одному с той же скоростью rate, поэтому отправки в популярное время не ждут elschool
+    before_sends: float = 15 * 60
+    # обновляется только кеш пользователей, которые пользовались ботом за это время
+    active_for: float = 24 * 60 * 60
+    # обновлений в секунду. Их запросы всё равно идут через общий ограничитель elschool
+    rate: float = 1
+    # через сколько секунд снова пробовать обновить кеш после временной ошибки elschool.
+    # После других ошибок, например устаревшего токена, кеш не обновляется заранее до конца времени кеширования
+    error_backoff: float = 60
+
+
 @dataclass
 class Config:
     bot: BotConfig
     logging: LoggingConfig
     dbfile: str
     storage_file: str = None
+    elschool: ElschoolConfig = field(default_factory=ElschoolConfig)
+    telegram: TelegramConfig = field(default_factory=TelegramConfig)
+    database: DatabaseConfig = field(default_factory=DatabaseConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    notifications: NotificationsConfig = field(default_factory=NotificationsConfig)
+    monitoring: MonitoringConfig = field(default_factory=MonitoringConfig)
+    prefetch: PrefetchConfig = field(default_factory=PrefetchConfig)
 
 
 def main():
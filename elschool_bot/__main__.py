@@ -9,6 +9,14 @@ from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 
 from elschool_bot import Config, BotConfig, LoggingConfig
 from elschool_bot.dialogs import register_handlers, set_commands
+from elschool_bot.dialogs.notifications.scheduler import Scheduler
+from elschool_bot.database import ConnectionPool
+from elschool_bot.migrations import Migrator
+from elschool_bot.cache import RepoCache
+from elschool_bot.monitoring import LoopLagMonitor
+from elschool_bot.prefetch import Prefetcher
+from elschool_bot.repository import ElschoolRepo, Refresher
+from elschool_bot.sending import SendQueue
 
 
 class PickleStorage(MemoryStorage):
@@ -29,7 +37,9 @@ class PickleStorage(MemoryStorage):
 def load_config():
     # TODO: загружать конфиг из файла
     return Config(
-        bot=BotConfig(token=os.environ['BOT_TOKEN'], parse_mode='html'),
+        bot=BotConfig(token=os.environ['BOT_TOKEN'], parse_mode='html',
+                      admin_ids=tuple(int(admin_id) for admin_id in os.environ.get('ADMIN_IDS', '').split(',')
+                                      if admin_id.strip())),
         logging=LoggingConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'),
         dbfile='bot.db'
     )
@@ -39,9 +49,35 @@ async def main():
     config = load_config()
     logging.basicConfig(level=config.logging.level, format=config.logging.format)
     bot = Bot(config.bot.token, default=DefaultBotProperties(parse_mode=config.bot.parse_mode))
+    send_queue = SendQueue(config.telegram)
+    bot.session.middleware(send_queue)
     storage = PickleStorage(config.storage_file) if config.storage_file is not None else MemoryStorage()
     dispatcher = Dispatcher(storage=storage, events_isolation=SimpleEventIsolation())
-    register_handlers(dispatcher, config)
+    elschool = ElschoolRepo(config.elschool)
+    migrator = Migrator(config.dbfile, config.database)
+    pool = ConnectionPool(config.dbfile, config.database)
+    dispatcher.startup.register(migrator.migrate)
+    dispatcher.startup.register(pool.open)
+    dispatcher.startup.register(migrator.start_backfills)
+    cache = RepoCache(config.cache)
+    refresher = Refresher(pool, elschool, cache)
+    scheduler = Scheduler(pool, elschool, cache, config.notifications)
+    dispatcher.startup.register(scheduler.start)
+    monitor = LoopLagMonitor(config.monitoring)
+    dispatcher.startup.register(monitor.start)
+    prefetcher = Prefetcher(pool, elschool, cache, config.prefetch, scheduler)
+    dispatcher.startup.register(prefetcher.start)
+    # выполняется по порядку: сначала останавливается всё, что ходит в elschool и базу данных,
+    # и только потом закрываются сессия, пул разбора страниц и соединения
+    dispatcher.shutdown.register(prefetcher.stop)
+    dispatcher.shutdown.register(refresher.stop)
+    dispatcher.shutdown.register(scheduler.stop)
+    dispatcher.shutdown.register(migrator.stop_backfills)
+    dispatcher.shutdown.register(monitor.stop)
+    dispatcher.shutdown.register(elschool.close)
+    dispatcher.shutdown.register(pool.close)
+    register_handlers(dispatcher, config, elschool, pool, cache, monitor, prefetcher, scheduler, send_queue,
+                      refresher)
     await set_commands(bot)
     await dispatcher.start_polling(bot)
     await storage.close()
@@ -0,0 +1,73 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'работает'
+OPEN = 'остановлен'
+HALF_OPEN = 'проверка'
+
+
+class CircuitBreaker:
+    """Перестаёт пропускать запросы к серверу, который несколько раз подряд не ответил.
+
+    Через reset_timeout секунд пропускается один пробный запрос. Если он успешен, запросы снова пропускаются,
+    если нет, ждём ещё reset_timeout.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probe_started = None
+        if self.state == HALF_OPEN:
+            # пробный запрос мог отмениться и ничего не сообщить, тогда через reset_timeout пускаем следующий
+            if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                logger.info(f'{self.name}: пробный запрос')
+                return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f'{self.name}: сервер снова отвечает')
+        self.state = CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def record_skipped(self):
+        """Пропущенный запрос так и не был отправлен. Если это была проба, можно пробовать следующим."""
+        if self.state == HALF_OPEN:
+            self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            logger.warning(f'{self.name}: сервер не отвечает {self.failures} раз подряд, '
+                           f'запросы остановлены на {self.reset_timeout} с')
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+            self.opens += 1
+
+    def stats(self):
+        return {
+            'запросы к серверу': self.state,
+            'ошибок подряд': self.failures,
+            'раз отключался': self.opens,
+            'отклонено запросов': self.rejected,
+        }
@@ -0,0 +1,86 @@
+import collections
+import time
+
+from elschool_bot import CacheConfig
+
+# get возвращает это, если ключа нет, потому что None тоже может быть сохранённым значением
+MISSING = object()
+
+
+class TTLCache:
+    """Хранит не больше maxsize значений и не дольше ttl секунд. Когда место кончается,
+    удаляется то, что дольше всех не запрашивали."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # ключ -> (время, до которого значение действует, значение)
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return MISSING
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'записей': len(self._data),
+            'попаданий': self.hits,
+            'промахов': self.misses,
+            'попаданий, %': round(self.hits / requests * 100, 1) if requests else 0,
+            'вытеснено': self.evictions,
+        }
+
+
+class RepoCache:
+    """Общий для всех Repo кеш строк пользователей и их оценок, чтобы не ходить за ними в базу данных
+    по несколько раз за одно нажатие. Repo сбрасывает его после каждой записи."""
+
+    def __init__(self, config: CacheConfig = None):
+        config = config or CacheConfig()
+        self.users = TTLCache(config.users, config.ttl)
+        # id пользователя -> (часть года, оценки за неё)
+        self.grades = TTLCache(config.grades, config.ttl)
+        # меняется при каждом сбросе. Прочитанное из базы сохраняется, только если за время чтения
+        # ничего не сбрасывалось, иначе можно сохранить уже изменённые данные
+        self.generation = 0
+
+    def invalidate_user(self, user_id):
+        self.generation += 1
+        self.users.pop(user_id)
+
+    def invalidate_grades(self, user_id):
+        self.generation += 1
+        self.grades.pop(user_id)
+
+    def stats(self):
+        return {
+            **{f'пользователи, {name}': value for name, value in self.users.stats().items()},
+            **{f'оценки, {name}': value for name, value in self.grades.stats().items()},
+        }
@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+import aiosqlite
+
+from elschool_bot import DatabaseConfig
+
+logger = logging.getLogger(__name__)
+
+# индексы под все частые запросы Repo, ключ это название индекса
+INDEXES = {
+    'grades_user_id_quarter': 'CREATE INDEX IF NOT EXISTS grades_user_id_quarter ON grades (user_id, quarter)',
+    'class_schedule_cache_class_id_date':
+        'CREATE INDEX IF NOT EXISTS class_schedule_cache_class_id_date ON class_schedule_cache (class_id, date)',
+    'schedule_changes_class_id_date':
+        'CREATE INDEX IF NOT EXISTS schedule_changes_class_id_date ON schedule_changes (class_id, date)',
+    'schedule_changes_date': 'CREATE INDEX IF NOT EXISTS schedule_changes_date ON schedule_changes (date)',
+    'users_class_id_notify_change_schedule':
+        'CREATE INDEX IF NOT EXISTS users_class_id_notify_change_schedule ON users (class_id, notify_change_schedule)',
+}
+
+
+async def connect(dbfile, config: DatabaseConfig):
+    connection = await aiosqlite.connect(dbfile)
+    await setup_connection(connection, config)
+    return connection
+
+
+async def setup_connection(connection: aiosqlite.Connection, config: DatabaseConfig):
+    cursor = await connection.execute(f'PRAGMA journal_mode={config.journal_mode}')
+    journal_mode, = await cursor.fetchone()
+    if journal_mode.lower() != config.journal_mode.lower():
+        logger.warning(f'не удалось включить режим журнала {config.journal_mode}, используется {journal_mode}')
+    await connection.execute(f'PRAGMA synchronous={config.synchronous}')
+    await connection.execute(f'PRAGMA cache_size={config.cache_size}')
+    await connection.execute(f'PRAGMA mmap_size={config.mmap_size}')
+    await connection.execute(f'PRAGMA temp_store={config.temp_store}')
+    await connection.execute(f'PRAGMA foreign_keys={"ON" if config.foreign_keys else "OFF"}')
+
+
+class ConnectionPool:
+    """Постоянные соединения с базой данных, которые открываются при запуске и выдаются по одному на событие."""
+
+    def __init__(self, dbfile, config: DatabaseConfig):
+        self.dbfile = dbfile
+        self.config = config
+        self.size = config.pool_size
+        self._connections = []
+        self._free = asyncio.Queue()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def open(self):
+        for _ in range(self.size):
+            connection = await connect(self.dbfile, self.config)
+            self._connections.append(connection)
+            self._free.put_nowait(connection)
+        logger.info(f'открыто {self.size} соединений с базой данных {self.dbfile}')
+
+    async def close(self):
+        for connection in self._connections:
+            await connection.close()
+        self._connections.clear()
+        self._free = asyncio.Queue()
+        logger.info('соединения с базой данных закрыты')
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        if not self._connections:
+            raise RuntimeError('соединения с базой данных ещё не открыты')
+        start = time.monotonic()
+        if self._free.empty():
+            self.waits += 1
+            logger.debug('все соединения с базой данных заняты, ждём свободное')
+        connection = await self._free.get()
+        wait_time = time.monotonic() - start
+        self.checkouts += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                # обработчик упал посреди изменений, они не должны попасть в следующее событие
+                await connection.rollback()
+            self._free.put_nowait(connection)
+
+    def lease(self):
+        return PooledConnection(self)
+
+    def stats(self):
+        return {
+            'размер пула': self.size,
+            'свободно соединений': self._free.qsize(),
+            'выдано соединений': self.checkouts,
+            'ожиданий соединения': self.waits,
+            'среднее ожидание, мс': round(self.wait_time / self.checkouts * 1000, 2) if self.checkouts else 0,
+            'максимальное ожидание, мс': round(self.max_wait_time * 1000, 2),
+        }
+
+
+class PooledConnection:
+    """Соединение из пула для одного события. Берётся при первом запросе к базе данных, а release отдаёт его
+    обратно, если сейчас нет открытых курсоров и транзакции. Repo делает это перед запросами к elschool,
+    которые могут идти минуту, чтобы остальные события и отправки по времени не ждали соединение."""
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self._lease = None
+        self._connection = None
+        self._cursors = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self._give_back()
+
+    async def _get(self) -> aiosqlite.Connection:
+        if self._connection is None:
+            lease = self.pool.acquire()
+            self._connection = await lease.__aenter__()
+            self._lease = lease
+        return self._connection
+
+    async def _give_back(self):
+        if self._connection is None:
+            return
+        lease = self._lease
+        self._lease = self._connection = None
+        # незавершённую транзакцию откатит пул
+        await lease.__aexit__(None, None, None)
+
+    async def release(self):
+        if self._connection is not None and not self._cursors and not self._connection.in_transaction:
+            await self._give_back()
+
+    @property
+    def in_transaction(self):
+        return self._connection is not None and self._connection.in_transaction
+
+    async def execute(self, sql, parameters=None):
+        return await (await self._get()).execute(sql, parameters)
+
+    async def executemany(self, sql, parameters):
+        return await (await self._get()).executemany(sql, parameters)
+
+    async def execute_fetchall(self, sql, parameters=None):
+        return await (await self._get()).execute_fetchall(sql, parameters)
+
+    async def commit(self):
+        if self._connection is not None:
+            await self._connection.commit()
+
+    async def rollback(self):
+        if self._connection is not None:
+            await self._connection.rollback()
+
+    @contextlib.asynccontextmanager
+    async def cursor(self):
+        connection = await self._get()
+        self._cursors += 1
+        try:
+            async with connection.cursor() as cursor:
+                yield cursor
+        finally:
+            self._cursors -= 1
@@ -6,8 +6,14 @@ from aiogram.filters.command import CommandStart, Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ErrorEvent, BotCommand, CallbackQuery
 from aiogram_dialog import DialogManager, StartMode, setup_dialogs
 from aiogram_dialog.api.entities import DIALOG_EVENT_NAME
-
-from elschool_bot.repository import RepoMiddleware, Repo, DataProcessError, RegisterError
+from aiogram_dialog.api.exceptions import OutdatedIntent
+
+from elschool_bot.cache import RepoCache
+from elschool_bot.database import ConnectionPool
+from elschool_bot.monitoring import LoopLagMonitor
+from elschool_bot.prefetch import Prefetcher, PrefetchMiddleware
+from elschool_bot.repository import RepoMiddleware, Repo, DataProcessError, RegisterError, ElschoolRepo, Refresher
+from elschool_bot.sending import SendQueue
 from . import settings, grades, input_data, notifications, date_selector, results_grades, schedule, help
 from .grades import start_select_grades
 from .notifications.scheduler import Scheduler, SchedulerMiddleware
@@ -132,6 +138,29 @@ async def restore_schedules(message: Message, dialog_manager: DialogManager, not
     await message.answer('все отправки восстановлены')
 
 
+@router.message(Command('stats'))
+async def show_stats(message: Message, db_pool: ConnectionPool, elschool: ElschoolRepo, repo_cache: RepoCache,
+                     loop_monitor: LoopLagMonitor, prefetcher: Prefetcher, notifications: Scheduler,
+                     send_queue: SendQueue, admin_ids: tuple):
+    if message.from_user.id not in admin_ids:
+        logger.info(f'пользователь с id {message.from_user.id} не разработчик, но попробовал посмотреть статистику')
+        return
+    logger.info(f'разработчик с id {message.from_user.id} решил посмотреть статистику')
+    stats = {'база данных': db_pool.stats(), 'кеш в памяти': repo_cache.stats(), 'elschool': elschool.stats(),
+             'цикл событий': loop_monitor.stats(), 'обновление кеша заранее': prefetcher.stats(),
+             'отправки по времени': notifications.stats(), 'telegram': send_queue.stats()}
+    await message.answer('\n\n'.join(
+        '\n'.join([f'<b>{section}</b>', *(f'{name}: {value}' for name, value in values.items())])
+        for section, values in stats.items()
+    ))
+
+
+@router.error(ExceptionTypeFilter(OutdatedIntent))
+async def on_outdated_intent(error: ErrorEvent):
+    # фоновое обновление пришло в диалог, который пользователь уже закрыл
+    logger.debug(f'обновление для закрытого диалога пропущено: {error.exception}')
+
+
 @router.error(ExceptionTypeFilter(DataProcessError))
 async def on_data_process_error(error: ErrorEvent, bot: Bot):
     chat_id, user_id = get_ids(error)
@@ -170,17 +199,29 @@ async def on_other_error(error: ErrorEvent, bot: Bot):
     logger.error(f'у пользователя c id {user_id} возникла необработанная ошибка', exc_info=exception)
 
 
-def register_handlers(dp: Dispatcher, config):
-    setup_dialogs(dp)
+def register_handlers(dp: Dispatcher, config, elschool: ElschoolRepo, pool: ConnectionPool, cache: RepoCache,
+                      loop_monitor: LoopLagMonitor, prefetcher: Prefetcher, scheduler: Scheduler,
+                      send_queue: SendQueue, refresher: Refresher = None):
+    scheduler.bg_factory = setup_dialogs(dp)
     dp.include_router(router)
-
-    middleware = RepoMiddleware(config.dbfile)
+    dp['db_pool'] = pool
+    dp['elschool'] = elschool
+    dp['repo_cache'] = cache
+    dp['loop_monitor'] = loop_monitor
+    dp['prefetcher'] = prefetcher
+    dp['send_queue'] = send_queue
+    dp['admin_ids'] = config.bot.admin_ids
+
+    prefetch_middleware = PrefetchMiddleware(prefetcher)
+    dp.message.middleware(prefetch_middleware)
+    dp.callback_query.middleware(prefetch_middleware)
+
+    middleware = RepoMiddleware(pool, elschool, cache, refresher)
     dp.message.middleware(middleware)
     dp.callback_query.middleware(middleware)
     dp.observers[DIALOG_EVENT_NAME].middleware(middleware)
 
-    scheduler_ = Scheduler()
-    scheduler_middleware = SchedulerMiddleware(scheduler_)
+    scheduler_middleware = SchedulerMiddleware(scheduler)
     dp.message.middleware(scheduler_middleware)
     dp.callback_query.middleware(scheduler_middleware)
 
@@ -6,7 +6,7 @@ from aiogram_dialog.widgets.kbd import Button
 from aiogram_dialog.widgets.text import Const
 
 from elschool_bot.dialogs import input_data
-from elschool_bot.repository import RegisterError
+from elschool_bot.repository import RegisterError, ServerError
 from elschool_bot.widgets import grades_select
 from elschool_bot.windows import select_lessons, status
 from .show import ShowStates, show_default, show_statistics
@@ -20,11 +20,11 @@ class GradesStates(StatesGroup):
     STATUS = State()
 
 
-async def start_get_grades(manager: DialogManager):
+async def start_get_grades(manager: DialogManager, allow_stale=False):
     repo = manager.middleware_data['repo']
     await status.update(manager, 'получаю оценки', ShowMode.EDIT)
     try:
-        grades = await repo.get_grades(manager.event.from_user.id)
+        grades = await repo.get_grades(manager.event.from_user.id, allow_stale)
     except RegisterError as e:
         if await handle_register_error(manager, repo, e):
             return await get_grades_after_error(manager, repo)
@@ -35,6 +35,10 @@ async def start_get_grades(manager: DialogManager):
 async def handle_register_error(manager, repo, error):
     status_text = manager.dialog_data['status']
     message = error.args[0]
+    if isinstance(error, ServerError):
+        # elschool не отвечает, новый токен тут не поможет
+        await status.update(manager, f'{status_text}, произошла ошибка:\n{message}')
+        return False
     text = f'{status_text}, произошла ошибка:\n{message}. Скорее всего elschool обновил токен.'
     login, password = await repo.get_user_data(manager.event.from_user.id)
     if login is None and password is None:
@@ -66,7 +70,7 @@ async def handle_register_error(manager, repo, error):
 
 async def start_select_grades(manager: DialogManager):
     await manager.start(GradesStates.STATUS, mode=StartMode.RESET_STACK)
-    grades = await start_get_grades(manager)
+    grades = await start_get_grades(manager, allow_stale=True)
     if grades is not None:
         await show_select(grades, manager)
 
@@ -136,15 +140,28 @@ async def on_process_result(start_data: dict, result, manager: DialogManager):
 
 
 async def show_select(grades, manager: DialogManager):
+    repo = manager.middleware_data['repo']
+    stale = repo.stale_warning()
+    text = 'оценки получил, теперь можешь выбрать'
+    if repo.refreshing is not None:
+        text = 'показываю сохранённые оценки, а новые пока получаю. Можешь выбирать'
+        status.update_when_refreshed(manager, repo.refreshing, refreshed_grades)
     status.set(
-        manager, 'оценки получил, теперь можешь выбрать',
-        checked_lessons='', checked_date_lesson='', checked_date='',
+        manager, f'{stale}\n{text}' if stale else text,
+        checked_lessons='', checked_date_lesson='', checked_date='', stale=stale,
         grades=grades, lessons=[{'id': i, 'text': item} for i, item in enumerate(grades)]
     )
     await manager.switch_to(GradesStates.SELECT)
     await manager.show(ShowMode.EDIT)
 
 
+def refreshed_grades(grades):
+    return {
+        'status': 'получил новые оценки, теперь можешь выбрать',
+        'grades': grades, 'lessons': [{'id': i, 'text': item} for i, item in enumerate(grades)]
+    }
+
+
 
 
 def filter_selected(selected):
@@ -223,7 +240,8 @@ async def on_show(query, button, manager: DialogManager):
         filters = filter_without_marks(show_without_marks),
         value_filters = (filter_lesson_date(lesson_dates, 'lesson_date'),
                          filter_lesson_date(dates, 'date'), filter_marks(marks_selected))
-        await show_statistics(grades, manager, marks_selected, filters, value_filters)
+        await show_statistics(grades, manager, marks_selected, filters, value_filters,
+                              stale=manager.dialog_data.get('stale'))
         return
 
     selected = set()
@@ -234,7 +252,7 @@ async def on_show(query, button, manager: DialogManager):
     filters = filter_selected(selected), filter_without_marks(show_without_marks)
     value_filters = (filter_lesson_date(lesson_dates, 'lesson_date'),
                      filter_lesson_date(dates, 'date'), filter_marks(marks_selected))
-    await show_default(grades, manager, filters, value_filters)
+    await show_default(grades, manager, filters, value_filters, stale=manager.dialog_data.get('stale'))
 
 
 async def on_start(data, manager: DialogManager):
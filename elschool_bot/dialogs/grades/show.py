@@ -129,7 +129,7 @@ def fix_text(marks, mean):
         return ''
 
 
-async def show_default(grades, manager, filters, value_filters, show_back=True):
+async def show_default(grades, manager, filters, value_filters, show_back=True, stale=None):
     text = []
     fix_lessons = {}
     for lesson, marks in grades.items():
@@ -147,7 +147,7 @@ async def show_default(grades, manager, filters, value_filters, show_back=True):
         values = ', '.join([str(mark['mark']) for mark in marks])
         text.append({'marks': f'<b>{lesson}</b> {values}, <b>средняя части года</b> {mean: .2f}',
                      'fix': fix_lessons[lesson]['fix']})
-    await manager.start(ShowStates.SHOW, {'text': text, 'show_back': show_back})
+    await manager.start(ShowStates.SHOW, {'text': text, 'show_back': show_back, 'stale': stale})
 
 
 def show_detail(grades, filters, value_filters):
@@ -270,13 +270,14 @@ def show_summary(grades, marks_selected):
     return '\n\n'.join(text)
 
 
-async def show_statistics(grades, manager, marks_selected, filters, value_filters, show_back=True):
+async def show_statistics(grades, manager, marks_selected, filters, value_filters, show_back=True, stale=None):
     lessons = show_detail(grades, filters, value_filters)
     if not lessons:
-        await manager.start(ShowStates.SHOW_BIG, {'lessons': lessons, 'show_back': show_back})
+        await manager.start(ShowStates.SHOW_BIG, {'lessons': lessons, 'show_back': show_back, 'stale': stale})
         return
     summary = show_summary(grades, marks_selected)
-    await manager.start(ShowStates.SHOW_SMALL, {'grades': summary, 'lessons': lessons, 'show_back': show_back})
+    await manager.start(ShowStates.SHOW_SMALL, {'grades': summary, 'lessons': lessons, 'show_back': show_back,
+                                                'stale': stale})
 
 
 class TextFromGetter(Text):
@@ -365,6 +366,7 @@ async def on_begin(event, button, manager: DialogManager):
 
 dialog = Dialog(
     Window(
+        Format('<i>{start_data[stale]}</i>\n', when=F['start_data']['stale']),
         Format('{start_data[grades]}'),
         Row(
             Button(Const('<<'), 'back', on_last),
@@ -376,6 +378,7 @@ dialog = Dialog(
         state=ShowStates.SHOW_SMALL
     ),
     Window(
+        Format('<i>{start_data[stale]}</i>\n', when=F['start_data']['stale']),
         Const('показываю оценки'),
         List(
             Case({
@@ -395,6 +398,7 @@ dialog = Dialog(
         state=ShowStates.SHOW
     ),
     Window(
+        Format('<i>{start_data[stale]}</i>\n', when=F['start_data']['stale']),
         TextFromGetter(text_getter),
         Row(
             Button(Const('<<'), 'back', on_back),
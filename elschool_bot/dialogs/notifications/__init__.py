@@ -68,6 +68,14 @@ async def on_save_autosend_schedule(event, button, manager: DialogManager):
 
     repo = manager.middleware_data['repo']
     await repo.set_user_autosend_schedule(event.from_user.id, time, interval)
+    notifications = manager.middleware_data['notifications']
+    notifications.remove_id_task(event.from_user.id, -1)
+    if time is not None:
+        try:
+            notifications.add_id_task(manager, time, -1, interval)
+        except ValueError:
+            # время введено вручную в непонятном виде, отправлять нечего
+            pass
     await manager.switch_to(NotificationStates.STATUS)
 
 
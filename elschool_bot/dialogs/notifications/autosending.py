@@ -176,7 +176,7 @@ async def on_save_schedule(query, button, manager: DialogManager):
         await repo.update_schedule(user_id, id, name, next_time, interval,
                                    show_mode.value, lessons, dates, marks, show_without_marks)
     scheduler = manager.middleware_data['notifications']
-    scheduler.add_id_task(manager, next_time, id)
+    scheduler.add_id_task(manager, next_time, id, int(interval))
     status.set(manager, 'отправка сохранена')
     await manager.switch_to(SchedulerStates.STATUS)
 
@@ -1,86 +1,280 @@
 import asyncio
+import calendar
 import datetime
+import heapq
+import itertools
+import logging
+import re
+import time
 from typing import Callable, Dict, Any, Awaitable
 
-from aiogram import BaseMiddleware
+from aiogram import BaseMiddleware, Bot
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import TelegramObject
 from aiogram_dialog import DialogManager, Dialog, BaseDialogManager, StartMode
+from aiogram_dialog.api.protocols import BgManagerFactory
 
+from elschool_bot import NotificationsConfig
+from elschool_bot.cache import RepoCache
+from elschool_bot import sending
+from elschool_bot.database import ConnectionPool
 from elschool_bot.dialogs import schedule
 from elschool_bot.dialogs.grades import (start_get_grades, process_result, show_default,
                                          filter_marks, filter_selected, filter_without_marks, show_statistics)
-from elschool_bot.repository import Repo
+from elschool_bot.repository import Repo, ElschoolRepo
 from elschool_bot.windows import status
 
+logger = logging.getLogger(__name__)
+
+# время отправок пользователи выбирают по Екатеринбургу
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=5))
+
 
 class SchedulerShowStates(StatesGroup):
     STATUS = State()
 
 
 class Scheduler:
-    def __init__(self):
-        self.tasks = {}
-
-    def add_id_task(self, manager: DialogManager, next_time, id):
+    """Отправки по времени. Все они лежат в одной куче по времени отправки,
+    и ждёт только один таймер до ближайшей, сколько бы отправок ни было.
+
+    Время следующей отправки сохраняется в базу данных, поэтому после перезапуска отправки
+    восстанавливаются сами и повторяющиеся отправки не сбиваются.
+    """
+
+    def __init__(self, pool: ConnectionPool, elschool: ElschoolRepo, cache: RepoCache, config: NotificationsConfig):
+        self.pool = pool
+        self.elschool = elschool
+        self.cache = cache
+        self.config = config
+        # задаётся в register_handlers, отправки начинаются через него от имени бота
+        self.bg_factory: BgManagerFactory = None
+        self.bot: Bot = None
+        # (id пользователя, id отправки) -> (время отправки, номер записи в куче, интервал повторения,
+        # день месяца первой отправки)
+        self.jobs = {}
+        # (время отправки, номер записи, ключ). Отменённые и перенесённые записи остаются в куче,
+        # пока не окажутся наверху, их отличает номер, которого уже нет в jobs
+        self._heap = []
+        self._numbers = itertools.count()
+        self._timer = None
+        self._timer_at = None
+        self._running = set()
+        # одноразовые отправки, которые уже начались, но ещё не удалены из базы данных
+        self._started_once = set()
+        # время следующих отправок, которое ещё нужно сохранить: ключ -> время
+        self._unsaved = {}
+        self._saving = None
+        self.fired = 0
+        self.misfired = 0
+        self.skipped = 0
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        await self.restore()
+
+    async def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._timer_at = None
+        if self._saving is not None:
+            await self._saving
+
+    def add_id_task(self, manager: DialogManager, next_time, id, interval=-1):
+        """Ставит отправку на ближайшее время next_time ("ЧЧ_ММ" или "ЧЧ:ММ").
+        interval: -1 - один раз, 0 - каждый день, 1 - каждую неделю, 2 - каждый месяц."""
         if next_time is None:
             raise ValueError('не выбрано время отправки')
-        delay = self.get_delay(next_time)
-        self.add_task(delay, id, manager)
-
-    def add_task(self, delay, id, manager):
-        task = asyncio.create_task(self.show_id(manager.bg(stack_id=''), id, delay))
-        self.tasks[(manager.event.from_user.id, id)] = task
-
-    def get_delay(self, next_time):
-        next_time = self.get_next_time(next_time)
-        return self.get_next_time_delay(next_time)
-
-    def get_next_time(self, next_time):
-        hour, minute = [int(i) for i in next_time.split('_')]
-        next_time = datetime.datetime.today().replace(hour=hour - 5, minute=minute)
-        return next_time
-
-    def get_next_time_delay(self, next_time):
-        now = datetime.datetime.utcnow()
-        if next_time <= now:
-            next_time += datetime.timedelta(days=1)
-        return (next_time - now).total_seconds()
-
-    def remove_id_task(self, user_id, id):
-        if (user_id, id) in self.tasks:
-            task = self.tasks.pop((user_id, id))
-            task.cancel()
-
-    def add_id_interval_task(self, manager: DialogManager, next_time, interval, id):
-        next_time = self.get_next_time(next_time)
+        when = self.first_run(next_time)
+        day = datetime.datetime.fromtimestamp(when, TIMEZONE).day
+        self._started_once.discard((manager.event.from_user.id, id))
+        self._schedule((manager.event.from_user.id, id), when, interval, day)
+        self._save(manager.event.from_user.id, id, when, day)
+
+    def _schedule(self, key, when, interval, day):
+        number = next(self._numbers)
+        self.jobs[key] = (when, number, -1 if interval is None else int(interval), day)
+        heapq.heappush(self._heap, (when, number, key))
+        self._arm()
+
+    @staticmethod
+    def first_run(next_time):
+        hour, minute = [int(i) for i in re.split('[_:]', next_time)]
+        now = datetime.datetime.now(TIMEZONE)
+        when = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if when <= now:
+            when += datetime.timedelta(days=1)
+        return when.timestamp()
+
+    @staticmethod
+    def following_run(when, interval, day=None):
+        """Следующее повторение после отправки в when или None, если отправка одноразовая.
+        day - день месяца первой отправки, по нему считаются ежемесячные отправки."""
+        when = datetime.datetime.fromtimestamp(when, TIMEZONE)
         if interval == 0:
-            next_time += datetime.timedelta(days=1)
+            when += datetime.timedelta(days=1)
         elif interval == 1:
-            next_time += datetime.timedelta(days=7)
+            when += datetime.timedelta(days=7)
+        elif interval == 2:
+            year, month = (when.year + 1, 1) if when.month == 12 else (when.year, when.month + 1)
+            # 31 число переносится на последний день короткого месяца, а в следующем снова будет 31
+            day = day or when.day
+            when = when.replace(year=year, month=month, day=min(day, calendar.monthrange(year, month)[1]))
         else:
-            next_month = next_time.month + 1
-            if next_month == 13:
-                next_month = 1
-                next_time = next_time.replace(year=next_time.year + 1)
-            next_time = next_time.replace(month=next_month)
-        delay = self.get_next_time_delay(next_time)
-        self.add_task(delay, id, manager)
-
-    async def show_id(self, manager: BaseDialogManager, id, delay):
-        await asyncio.sleep(delay)
-        await manager.start(SchedulerShowStates.STATUS, {'notifications': self, 'id': id}, StartMode.NEW_STACK)
+            return None
+        return when.timestamp()
+
+    def remove_id_task(self, user_id, id):
+        self._started_once.discard((user_id, id))
+        if self.jobs.pop((user_id, id), None) is None:
+            return
+        if len(self._heap) > 2 * len(self.jobs) + 64:
+            # отменённых записей стало больше, чем нужных, пересобираем кучу без них
+            self._heap = [(when, number, key) for key, (when, number, _, _) in self.jobs.items()]
+            heapq.heapify(self._heap)
+        self._arm()
+
+    def due_before(self, before):
+        """Отправки, которые начнутся раньше before, по порядку: (время, id пользователя, id отправки)."""
+        return sorted((when, user_id, id) for (user_id, id), (when, _, _, _) in self.jobs.items() if when < before)
+
+    def _is_current(self, entry):
+        _, number, key = entry
+        job = self.jobs.get(key)
+        return job is not None and job[1] == number
+
+    def _arm(self):
+        """Ставит таймер на ближайшую отправку."""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = self._timer_at = None
+            return
+        when = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer_at == when:
+                return
+            self._timer.cancel()
+        self._timer_at = when
+        self._timer = asyncio.get_running_loop().call_later(max(0.0, when - time.time()), self._fire)
+
+    def _fire(self):
+        self._timer = self._timer_at = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._is_current(entry):
+                continue
+            when, _, key = entry
+            user_id, id = key
+            _, _, interval, day = self.jobs.pop(key)
+            # следующее повторение ставится сразу, даже если эта отправка не получится
+            following = self.following_run(when, interval, day)
+            if following is not None:
+                self._schedule(key, following, interval, day)
+                self._save(user_id, id, following, day)
+            else:
+                self._started_once.add(key)
+            self.fired += 1
+            task = asyncio.create_task(self.show_id(user_id, id))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        self._arm()
+
+    async def show_id(self, user_id, id):
+        try:
+            manager: BaseDialogManager = self.bg_factory.bg(self.bot, user_id, user_id, stack_id='')
+            with sending.bulk():
+                await manager.start(SchedulerShowStates.STATUS, {'notifications': self, 'id': id}, StartMode.NEW_STACK)
+        except Exception:
+            logger.exception(f'не удалось начать отправку с id {id} пользователю с id {user_id}')
+
+    def _save(self, user_id, id, when, day):
+        self._unsaved[(user_id, id)] = (when, day)
+        if self._saving is None:
+            self._saving = asyncio.create_task(self._save_unsaved())
+
+    async def _save_unsaved(self):
+        # все изменения, накопившиеся за время записи, сохраняются следующей пачкой
+        try:
+            while self._unsaved:
+                next_runs = [(user_id, id, when, day) for (user_id, id), (when, day) in self._unsaved.items()]
+                self._unsaved.clear()
+                try:
+                    async with self.pool.acquire() as connection:
+                        await Repo(connection, self.elschool, cache=self.cache).set_next_runs(next_runs)
+                except Exception:
+                    logger.exception(f'не удалось сохранить время {len(next_runs)} отправок')
+        finally:
+            self._saving = None
+
+    async def restore(self):
+        """Загружает отправки из базы данных. Пропущенные, пока бот не работал, отправки выполняются,
+        если опоздали не больше чем на misfire_grace_time, из нескольких пропущенных повторений только последнее.
+        Отправки, которые уже есть в планировщике, не трогаются, поэтому повторный вызов ничего не повторит."""
+        async with self.pool.acquire() as connection:
+            schedules = await Repo(connection, self.elschool, cache=self.cache).get_schedules_for_restore()
+        now = time.time()
+        restored = 0
+        expired = []
+        for user_id, id, next_time, interval, next_run, day in schedules:
+            key = (user_id, id)
+            if key in self.jobs or key in self._started_once:
+                continue
+            interval = -1 if interval is None else int(interval)
+            if day is None and next_run is not None:
+                # сохранено до того, как стал сохраняться день месяца, точнее уже не узнать
+                day = datetime.datetime.fromtimestamp(next_run, TIMEZONE).day
+            if next_run is None:
+                # отправка сохранена до того, как стало сохраняться время следующей отправки
+                try:
+                    next_run = self.first_run(next_time)
+                except ValueError:
+                    logger.warning(f'у отправки с id {id} пользователя с id {user_id} непонятное время {next_time!r}')
+                    continue
+                day = datetime.datetime.fromtimestamp(next_run, TIMEZONE).day
+                self._save(user_id, id, next_run, day)
+            elif next_run <= now:
+                missed = next_run
+                following = self.following_run(missed, interval, day)
+                while following is not None and following <= now:
+                    missed, following = following, self.following_run(following, interval, day)
+                if now - missed <= self.config.misfire_grace_time:
+                    # время в прошлом, поэтому отправка начнётся сразу, а следующая встанет в свою фазу
+                    self.misfired += 1
+                    next_run = missed
+                elif following is not None:
+                    self.skipped += 1
+                    next_run = following
+                    self._save(user_id, id, next_run, day)
+                else:
+                    # одноразовая отправка уже не выполнится, в базе данных она больше не нужна
+                    self.skipped += 1
+                    expired.append(key)
+                    continue
+            self._schedule(key, next_run, interval, day)
+            restored += 1
+        if expired:
+            async with self.pool.acquire() as connection:
+                await Repo(connection, self.elschool, cache=self.cache).remove_expired_schedules(expired)
+        logger.info(f'восстановлено {restored} отправок, из них опоздавших {self.misfired}, '
+                    f'удалено опоздавших одноразовых {len(expired)}')
 
     async def restore_id_task(self, manager: DialogManager):
-        repo = manager.middleware_data['repo']
-        schedules = await repo.get_schedules_for_restore()
-        for user_id, user_schedules in schedules.items():
-            bg = manager.bg(user_id, user_id, stack_id='')
-            for schedule in user_schedules:
-                id = schedule['id']
-                delay = self.get_delay(schedule['next_time'])
-                task = asyncio.create_task(self.show_id(bg, id, delay))
-                self.tasks[(user_id, id)] = task
+        await self.restore()
+
+    def stats(self):
+        return {
+            'запланировано': len(self.jobs),
+            'записей в куче': len(self._heap),
+            'ближайшая через, с': round(self._heap[0][0] - time.time()) if self._heap else '-',
+            'начато отправок': self.fired,
+            'выполнено опоздавших': self.misfired,
+            'пропущено опоздавших': self.skipped,
+            'не сохранено': len(self._unsaved),
+        }
 
 
 class SchedulerMiddleware(BaseMiddleware):
@@ -133,14 +327,14 @@ async def select_grades(grades, manager: DialogManager):
         filters += (filter_selected(selected),)
 
     value_filters = filter_marks(marks_selected), filter_mark_date(date)
+    stale = repo.stale_warning()
     if show_mode == 0:
-        await show_default(grades, manager, filters, value_filters, False)
+        await show_default(grades, manager, filters, value_filters, False, stale)
     else:
-        await show_statistics(grades, manager, marks_selected, filters, value_filters, False)
+        await show_statistics(grades, manager, marks_selected, filters, value_filters, False, stale)
 
-    if interval != -1:
-        scheduler.add_id_interval_task(manager, next_time, interval, id)
-    else:
+    # следующее повторение планировщик уже поставил, одноразовая отправка удаляется
+    if interval == -1:
         await repo.remove_schedule(user_id, id)
         scheduler.remove_id_task(user_id, id)
 
@@ -154,9 +348,7 @@ async def show_schedule(manager: DialogManager):
     time, interval = await repo.get_user_autosend_schedule(user_id)
     scheduler = manager.start_data['notifications']
 
-    if interval != -1:
-        scheduler.add_id_interval_task(manager, time, interval, -1)
-    else:
+    if interval is None or interval == -1:
         await repo.set_user_autosend_schedule(user_id, None, -1)
         scheduler.remove_id_task(user_id, -1)
 
@@ -1,12 +1,18 @@
+import asyncio
+import contextlib
 import datetime
+import html
+import logging
 
-from aiogram import F, Router
+from aiogram import F, Router, Bot
+from aiogram.exceptions import TelegramAPIError
 from aiogram.fsm.state import StatesGroup, State
-from aiogram_dialog import ChatEvent, Dialog, Window, DialogManager, BaseDialogManager, StartMode
+from aiogram_dialog import ChatEvent, Dialog, Window, DialogManager, BaseDialogManager
 from aiogram_dialog.widgets.input import TextInput
 from aiogram_dialog.widgets.text import Format, Const, List, Multi
 from aiogram_dialog.widgets.kbd import ManagedCalendar, Button, Select, SwitchTo, Group, Checkbox, Row, Column
 
+from elschool_bot import sending
 from elschool_bot.dialogs import grades
 from elschool_bot.repository import Repo, RegisterError
 from elschool_bot.widgets.ru_calendar import RuCalendar
@@ -14,6 +20,15 @@ from elschool_bot.windows import status
 from . import edit
 from ..grades.show import fix_text, mean_mark
 
+logger = logging.getLogger(__name__)
+
+# сколько одноклассников уведомляется об изменениях одновременно
+NOTIFY_CONCURRENCY = 10
+# как часто в секундах обновляется сообщение о том, скольким одноклассникам уже отправлены изменения
+NOTIFY_PROGRESS_INTERVAL = 5
+# ссылки на задачи отправки изменений, чтобы их не удалил сборщик мусора
+_notifying = set()
+
 
 class ScheduleStates(StatesGroup):
     SELECT_DAY = State()
@@ -41,11 +56,6 @@ async def start_date(manager: DialogManager, date):
     await manager.start(ScheduleStates.STATUS, {'type': 'date', 'date': date})
 
 
-async def start_schedule(manager: BaseDialogManager, schedule, day):
-    await manager.start(ScheduleStates.STATUS, {'type': 'schedule', 'schedule': schedule, 'day': day},
-                        mode=StartMode.NEW_STACK)
-
-
 async def on_select_day(event: ChatEvent, widget: ManagedCalendar, manager: DialogManager, date):
     repo: Repo = manager.middleware_data['repo']
     await manager.switch_to(ScheduleStates.STATUS)
@@ -71,31 +81,12 @@ def save_lessons(schedule, manager: DialogManager):
 
 async def show_schedule(manager: DialogManager, schedule):
     lessons = save_lessons(schedule, manager)
+    repo = manager.middleware_data.get('repo')
+    if repo is not None and repo.refreshing is not None:
+        manager.dialog_data['stale'] = 'показываю сохранённое расписание, а новое пока получаю'
+        status.update_when_refreshed(manager, repo.refreshing, refreshed_schedule(manager.dialog_data['day']))
     if manager.dialog_data.get('time'):
-        now = datetime.datetime.utcnow() + datetime.timedelta(hours=5)
-        end_time = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        start_time = as_datetime(lessons[0]['start_time'])
-        if end_time < now < start_time:
-            current = 'сейчас пока нет уроков, следующий в ' + lessons[0]['start_time']
-        else:
-            for lesson in lessons:
-                start_time = as_datetime(lesson['start_time'])
-                number = lesson['number']
-                name = lesson['name']
-                if end_time < now < start_time:
-                    current = f'сейчас перемена, следующий урок будет {number}. {name} в {lesson["start_time"]}'
-                    break
-                end_time = as_datetime(lesson['end_time'])
-                if start_time < now < end_time:
-                    current = f'сейчас идёт урок {number}. {name}. Он закончится в {lesson["end_time"]}'
-                    break
-            else:
-                if now > end_time:
-                    current = 'все уроки закончились. Может ты дома?'
-                else:
-                    current = ('я вроде все ситуации учитываю, но эту чего-то не знаю. '
-                               'Когда она произошла? Это будет полезная информация для разработчика.')
-        manager.dialog_data['current'] = current
+        manager.dialog_data['current'] = current_lesson(lessons)
         await manager.switch_to(ScheduleStates.SHOW_TIME_SCHEDULE)
     elif manager.dialog_data.get('homework'):
         await manager.switch_to(ScheduleStates.SELECT_LESSON_HOMEWORK)
@@ -103,11 +94,68 @@ async def show_schedule(manager: DialogManager, schedule):
         await manager.switch_to(ScheduleStates.SHOW)
 
 
+def current_lesson(lessons):
+    now = datetime.datetime.utcnow() + datetime.timedelta(hours=5)
+    end_time = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_time = as_datetime(lessons[0]['start_time'])
+    if end_time < now < start_time:
+        return 'сейчас пока нет уроков, следующий в ' + lessons[0]['start_time']
+    for lesson in lessons:
+        start_time = as_datetime(lesson['start_time'])
+        number = lesson['number']
+        name = lesson['name']
+        if end_time < now < start_time:
+            return f'сейчас перемена, следующий урок будет {number}. {name} в {lesson["start_time"]}'
+        end_time = as_datetime(lesson['end_time'])
+        if start_time < now < end_time:
+            return f'сейчас идёт урок {number}. {name}. Он закончится в {lesson["end_time"]}'
+    if now > end_time:
+        return 'все уроки закончились. Может ты дома?'
+    return ('я вроде все ситуации учитываю, но эту чего-то не знаю. '
+            'Когда она произошла? Это будет полезная информация для разработчика.')
+
+
+def refreshed_schedule(day):
+    # пока расписание обновлялось, пользователь мог выбрать другой день,
+    # поэтому новое расписание подставляется в apply_refreshed, только если день тот же
+    def make_data(schedule):
+        return {'refreshed': {'day': day, 'schedule': schedule}}
+
+    return make_data
+
+
+async def apply_refreshed(dialog_manager: DialogManager, **kwargs):
+    dialog_data = dialog_manager.dialog_data
+    refreshed = dialog_data.pop('refreshed', None)
+    if refreshed is None or refreshed['day'] != dialog_data.get('day'):
+        return {}
+    problem = schedule_problem(refreshed['schedule'])
+    if problem:
+        # на elschool уроков в этот день больше нет, сохранённые показывать нельзя
+        save_lessons({}, dialog_manager)
+        dialog_data['stale'] = problem
+        dialog_data['current'] = ''
+        return {}
+    # оценки уже могли показать, их нужно перенести на новое расписание
+    marks = {}
+    if dialog_data.get('has_marks'):
+        marks = {lesson['name']: (lesson['marks'], lesson['fix']) for lesson in dialog_data['lessons']}
+    lessons = save_lessons(refreshed['schedule'], dialog_manager)
+    if marks:
+        for lesson in lessons:
+            lesson['marks'], lesson['fix'] = marks.get(lesson['name'], ('', ''))
+    if dialog_data.get('time'):
+        dialog_data['current'] = current_lesson(lessons)
+    dialog_data['stale'] = ''
+    return {}
+
+
 async def get_schedule_after_error(manager, repo: Repo, date):
     try:
         schedule = await repo.get_diaries(manager.event.from_user.id, date)
         if not await check_schedule(schedule, manager):
             return None
+        manager.dialog_data['stale'] = repo.stale_warning()
     except RegisterError as e:
         status_text = manager.dialog_data['status']
         message = e.args[0]
@@ -116,12 +164,19 @@ async def get_schedule_after_error(manager, repo: Repo, date):
         return schedule
 
 
-async def check_schedule(schedule, manager):
-    if schedule is None:
-        await status.update(manager, 'не найдено расписание на этот день')
-        return False
+def schedule_problem(schedule):
+    """Почему расписание нельзя показать, или None, если можно."""
     if isinstance(schedule, str):
-        await status.update(manager, schedule)
+        return schedule
+    if not schedule:
+        return 'не найдено расписание на этот день'
+    return None
+
+
+async def check_schedule(schedule, manager):
+    problem = schedule_problem(schedule)
+    if problem:
+        await status.update(manager, problem)
         return False
     return True
 
@@ -129,9 +184,10 @@ async def check_schedule(schedule, manager):
 async def get_schedule(manager: DialogManager, repo: Repo, date):
     try:
         manager.dialog_data['day'] = date
-        schedule = await repo.get_diaries(manager.event.from_user.id, date)
+        schedule = await repo.get_diaries(manager.event.from_user.id, date, allow_stale=True)
         if not await check_schedule(schedule, manager):
             return None
+        manager.dialog_data['stale'] = repo.stale_warning()
     except RegisterError as e:
         status.set(manager, 'получение расписания')
         if await grades.handle_register_error(manager, repo, e):
@@ -166,11 +222,66 @@ async def on_process_result(start_data, result, manager: DialogManager):
 
 
 async def notify_users(manager, repo, user_id):
-    class_users = await repo.get_class_users_notify_change_schedule(user_id)
-    schedule = manager.dialog_data['schedule']
-    day = manager.dialog_data['day']
-    for user in class_users:
-        await start_schedule(manager.bg(user, user, ''), schedule, day)
+    """Отправляет изменённое расписание одноклассникам в фоне. Тот, кто изменил, сразу видит, скольким оно отправляется,
+    пока идут отправки, раз в NOTIFY_PROGRESS_INTERVAL секунд видит, скольким уже отправлено,
+    а когда все отправки закончатся, сколько их получило."""
+    class_users = [user for user in await repo.get_class_users_notify_change_schedule(user_id) if user != user_id]
+    if not class_users:
+        return
+    text = render_changed_schedule(manager.dialog_data['schedule'], manager.dialog_data['day'])
+    manager.dialog_data['notified'] = f'изменения отправляются одноклассникам: {len(class_users)}'
+    task = asyncio.create_task(send_to_users(manager.middleware_data['bot'], manager.bg(), class_users, text))
+    _notifying.add(task)
+    task.add_done_callback(_notifying.discard)
+
+
+def render_changed_schedule(schedule, day):
+    lessons = sorted(schedule.values(), key=lambda item: item['number'])
+    items = []
+    for lesson in lessons:
+        item = f'{lesson["number"]}. {html.escape(lesson["name"])}\n{lesson["start_time"]} - {lesson["end_time"]}'
+        if lesson.get('homework'):
+            item += f'\nдомашнее задание:\n{html.escape(lesson["homework"])}'
+        items.append(item)
+    return f'изменилось расписание на {day:%d.%m.%Y}\n' + '\n\n'.join(items)
+
+
+async def send_to_users(bot: Bot, editor: BaseDialogManager, users, text):
+    total = len(users)
+    users = iter(users)
+    sent = 0
+    done = 0
+
+    async def worker():
+        nonlocal sent, done
+        for user in users:
+            try:
+                await bot.send_message(user, text)
+                sent += 1
+            except TelegramAPIError as e:
+                # например, пользователь заблокировал бота
+                logger.info(f'не удалось отправить изменения расписания пользователю с id {user}: {e}')
+            done += 1
+
+    async def report_progress():
+        reported = 0
+        while True:
+            await asyncio.sleep(NOTIFY_PROGRESS_INTERVAL)
+            if done != reported:
+                reported = done
+                await editor.update({'notified': f'изменения отправляются одноклассникам: '
+                                                 f'отправлено {done} из {total}, получили {sent}'})
+
+    progress = asyncio.create_task(report_progress())
+    try:
+        with sending.bulk():
+            await asyncio.gather(*(worker() for _ in range(min(NOTIFY_CONCURRENCY, total))))
+    finally:
+        progress.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await progress
+    logger.info(f'изменения расписания получили {sent} из {total} одноклассников')
+    await editor.update({'notified': f'изменения получили одноклассники: {sent} из {total}'})
 
 
 async def on_edit(event, button, manager: DialogManager):
@@ -299,6 +410,7 @@ dialog = Dialog(
         state=ScheduleStates.SELECT_DAY),
     Window(Format('{status}'), state=ScheduleStates.STATUS, getter=getter),
     Window(
+        Format('<i>{dialog_data[stale]}</i>\n', when=F['dialog_data']['stale']),
         Format('расписание на {dialog_data[day]: %d.%m.%Y}'),
         List(
             Multi(
@@ -311,6 +423,7 @@ dialog = Dialog(
             items=F['dialog_data']['lessons'],
             sep='\n\n'
         ),
+        Format('<i>{dialog_data[notified]}</i>', when=F['dialog_data']['notified']),
         Button(Const('изменения в расписании'), 'edit', on_click=on_edit),
         Row(
             Checkbox(Const('✓ оценки'), Const('оценки'), 'marks', on_state_changed=on_marks),
@@ -319,7 +432,8 @@ dialog = Dialog(
         state=ScheduleStates.SHOW
     ),
     Window(
-        Format('{dialog_data[current]}'),
+        Format('<i>{dialog_data[stale]}</i>\n', when=F['dialog_data']['stale']),
+        Format('{dialog_data[current]}', when=F['dialog_data']['current']),
         List(
             Format('{item[number]}. {item[start_time]} - {item[end_time]}'),
             items=F['dialog_data']['lessons']
@@ -337,6 +451,7 @@ dialog = Dialog(
         state=ScheduleStates.SELECT_DEFAULT_EDIT_DAY
     ),
     Window(
+        Format('<i>{dialog_data[stale]}</i>\n', when=F['dialog_data']['stale']),
         Const('выбери урок, для которого хочешь записать домашнее задание'),
         Column(
             Select(
@@ -355,7 +470,8 @@ dialog = Dialog(
         state=ScheduleStates.INPUT_LESSON_HOMEWORK
     ),
     on_process_result=on_process_result,
-    on_start=on_start
+    on_start=on_start,
+    getter=apply_refreshed
 )
 
 
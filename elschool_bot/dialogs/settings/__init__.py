@@ -4,7 +4,7 @@ from aiogram.types import User, CallbackQuery
 from aiogram_dialog import Dialog, Window, DialogManager
 from aiogram_dialog.widgets.input import TextInput
 from aiogram_dialog.widgets.kbd import Button, Row, Select, SwitchTo
-from aiogram_dialog.widgets.text import Const, Format
+from aiogram_dialog.widgets.text import Case, Const, Format
 
 from elschool_bot.repository import Repo
 from . import register, remove_data
@@ -201,6 +201,18 @@ async def on_input_cache_time(message, widget, manager: DialogManager, text: str
     await repo.set_cache_time(message.from_user.id, seconds)
 
 
+async def get_cache_data(repo: Repo, event_from_user: User, **kwargs):
+    return {
+        'stale_while_revalidate': await repo.get_stale_while_revalidate(event_from_user.id)
+    }
+
+
+async def on_stale_while_revalidate(query: CallbackQuery, button, manager: DialogManager):
+    repo: Repo = manager.middleware_data['repo']
+    stale_while_revalidate = await repo.get_stale_while_revalidate(query.from_user.id)
+    await repo.set_stale_while_revalidate(query.from_user.id, not stale_while_revalidate)
+
+
 dialog = Dialog(
     Window(
         status.create_status_widget(),
@@ -235,9 +247,16 @@ dialog = Dialog(
         Const('Чтобы не мучать постоянными запросами сервер elschool, я на некоторое время сохраняю оценки. '
               'Сейчас ты можешь написать мне время, которое я не буду обновлять твои оценки '
               'после предыдущего получения. Стандартное время 1 час. '
-              'Можно писать по разному. Например 20 минут 10 секунд или 20:10 или 21 минута или 1200 секунд.'),
+              'Можно писать по разному. Например 20 минут 10 секунд или 20:10 или 21 минута или 1200 секунд.\n\n'
+              'Ещё я могу не заставлять ждать, когда время прошло: сразу показать сохранённые оценки и расписание, '
+              'а новые получить в фоне и обновить сообщение, если что-то изменилось.'),
         TextInput('cache_time', on_success=on_input_cache_time),
+        Button(Case({
+            True: Const('✓ показывать сохранённое, пока получаю новое'),
+            False: Const('показывать сохранённое, пока получаю новое'),
+        }, F['stale_while_revalidate']), 'stale_while_revalidate', on_stale_while_revalidate),
         SwitchTo(Const('отмена'), 'cancel_cache_time', States.MAIN),
+        getter=get_cache_data,
         state=States.EDIT_CACHE_TIME
     ),
     on_process_result=on_result,
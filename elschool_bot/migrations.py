@@ -0,0 +1,278 @@
+import asyncio
+import contextlib
+import logging
+
+import aiosqlite
+
+from elschool_bot import DatabaseConfig
+from elschool_bot.database import INDEXES, connect
+from elschool_bot.repository import class_id_from_url
+
+logger = logging.getLogger(__name__)
+
+
+async def add_column(connection: aiosqlite.Connection, table, column, definition):
+    """Добавляет столбец, если его ещё нет. Раньше схема менялась скриптами вручную, поэтому он может уже быть."""
+    cursor = await connection.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] async for row in cursor]:
+        await connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+async def create_tables(connection: aiosqlite.Connection):
+    await connection.execute('''CREATE TABLE IF NOT EXISTS users  (
+        id INTEGER PRIMARY KEY,
+        jwtoken TEXT,
+        url TEXT,
+        quarter TEXT,
+        login TEXT,
+        password TEXT,
+        last_cache INTEGER NOT NULL DEFAULT 0,
+        cache_time INTEGER DEFAULT 3600)''')
+    await connection.execute('''CREATE TABLE IF NOT EXISTS grades  (
+        user_id INTEGER,
+        lesson_name TEXT,
+        lesson_date TEXT,
+        date TEXT,
+        mark INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE)''')
+    await connection.execute('''CREATE TABLE IF NOT EXISTS schedules  (
+        user_id INTEGER,
+        id INTEGER,
+        name TEXT,
+        next_time INTEGER,
+        interval INTEGER,
+        show_mode INTEGER,
+        lessons TEXT,
+        dates INTEGER,
+        marks TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+        PRIMARY KEY (user_id, id))''')
+
+
+async def add_schedule(connection: aiosqlite.Connection):
+    await connection.execute('''CREATE TABLE IF NOT EXISTS schedule_cache (
+        user_id INTEGER,
+        date TEXT,
+        number INTEGER,
+        name TEXT,
+        start_time TEXT,
+        end_time TEXT,
+        homework TEXT
+    )''')
+    await add_column(connection, 'users', 'schedule_last_cache', 'INTEGER NOT NULL DEFAULT 0')
+
+
+async def add_schedule_changes(connection: aiosqlite.Connection):
+    await add_column(connection, 'users', 'class_id', 'INTEGER')
+    await connection.execute('''CREATE TABLE IF NOT EXISTS schedule_changes (
+        class_id INTEGER,
+        date INTEGER,
+        number INTEGER,
+        name TEXT,
+        start_time TEXT,
+        end_time TEXT,
+        homework TEXT,
+        homework_next INTEGER,
+        remove INTEGER
+        )''')
+
+
+async def add_schedule_notifications(connection: aiosqlite.Connection):
+    await add_column(connection, 'users', 'autosend_schedule_time', 'TEXT')
+    await add_column(connection, 'users', 'autosend_schedule_interval', 'INTEGER DEFAULT 1')
+    await add_column(connection, 'users', 'notify_change_schedule', 'INTEGER')
+
+
+async def add_show_without_marks(connection: aiosqlite.Connection):
+    await add_column(connection, 'schedules', 'show_without_marks', 'INTEGER DEFAULT 0')
+
+
+async def add_class_schedule_cache(connection: aiosqlite.Connection):
+    await connection.execute('''CREATE TABLE IF NOT EXISTS class_schedule_cache (
+        class_id INTEGER,
+        year INTEGER,
+        week INTEGER,
+        date TEXT,
+        number INTEGER,
+        name TEXT,
+        start_time TEXT,
+        end_time TEXT,
+        homework TEXT
+    )''')
+    await connection.execute('''CREATE TABLE IF NOT EXISTS class_schedule_weeks (
+        class_id INTEGER,
+        year INTEGER,
+        week INTEGER,
+        last_cache INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (class_id, year, week)
+    )''')
+    await connection.execute('DROP TABLE IF EXISTS schedule_cache')
+
+
+async def fix_schedule_changes_foreign_key(connection: aiosqlite.Connection):
+    # внешний ключ на не уникальный users(class_id) ломает любую запись в таблицу при PRAGMA foreign_keys=ON
+    await connection.execute('''CREATE TABLE schedule_changes_new (
+        class_id INTEGER,
+        date INTEGER,
+        number INTEGER,
+        name TEXT,
+        start_time TEXT,
+        end_time TEXT,
+        homework TEXT,
+        homework_next INTEGER,
+        remove INTEGER
+        )''')
+    await connection.execute('INSERT INTO schedule_changes_new SELECT * FROM schedule_changes')
+    await connection.execute('DROP TABLE schedule_changes')
+    await connection.execute('ALTER TABLE schedule_changes_new RENAME TO schedule_changes')
+    await connection.execute('DELETE FROM grades WHERE user_id NOT IN (SELECT id FROM users)')
+    await connection.execute('DELETE FROM schedules WHERE user_id NOT IN (SELECT id FROM users)')
+
+
+async def add_indexes(connection: aiosqlite.Connection):
+    await connection.execute('CREATE INDEX IF NOT EXISTS grades_user_id ON grades (user_id)')
+    await connection.execute('CREATE INDEX IF NOT EXISTS class_schedule_cache_class_id_date '
+                             'ON class_schedule_cache (class_id, date)')
+    await connection.execute('CREATE INDEX IF NOT EXISTS schedule_changes_class_id_date '
+                             'ON schedule_changes (class_id, date)')
+    await connection.execute('CREATE INDEX IF NOT EXISTS schedule_changes_date ON schedule_changes (date)')
+    await connection.execute('CREATE INDEX IF NOT EXISTS users_class_id_notify_change_schedule '
+                             'ON users (class_id, notify_change_schedule)')
+
+
+async def add_grades_quarter(connection: aiosqlite.Connection):
+    # в кеше хранятся оценки за все части года. Старые строки без части года не подходят, кеш заполнится заново
+    await add_column(connection, 'grades', 'quarter', 'TEXT')
+    await connection.execute('DELETE FROM grades')
+    await connection.execute('UPDATE users SET last_cache=0')
+    await connection.execute('DROP INDEX IF EXISTS grades_user_id')
+
+
+async def add_stale_while_revalidate(connection: aiosqlite.Connection):
+    await add_column(connection, 'users', 'stale_while_revalidate', 'INTEGER DEFAULT 0')
+
+
+async def add_next_run(connection: aiosqlite.Connection):
+    # время следующей отправки в секундах unix, чтобы после перезапуска не терять и не повторять отправки
+    await add_column(connection, 'schedules', 'next_run', 'REAL')
+    await add_column(connection, 'users', 'autosend_schedule_next_run', 'REAL')
+
+
+async def fix_schedule_weeks_iso_year(connection: aiosqlite.Connection):
+    # неделя хранилась с календарным годом вместо года по ISO, недели на стыке лет могли перепутаться.
+    # Сохранённое расписание заполнится заново
+    await connection.execute('DELETE FROM class_schedule_cache')
+    await connection.execute('DELETE FROM class_schedule_weeks')
+
+
+async def add_run_day(connection: aiosqlite.Connection):
+    # день месяца первой отправки: ежемесячная отправка 31 числа после короткого месяца снова приходит 31
+    await add_column(connection, 'schedules', 'run_day', 'INTEGER')
+    await add_column(connection, 'users', 'autosend_schedule_run_day', 'INTEGER')
+
+
+async def drop_expiring_indexes(connection: aiosqlite.Connection):
+    # заранее обновляется кеш только активных пользователей, их строки ищутся по id, и эти индексы не нужны
+    await connection.execute('DROP INDEX IF EXISTS users_cache_expires')
+    await connection.execute('DROP INDEX IF EXISTS class_schedule_weeks_year_week')
+
+
+async def create_indexes(connection: aiosqlite.Connection):
+    """Создаёт индексы из database.INDEXES, которых ещё нет. Выполняется после всех шагов при каждом запуске."""
+    for sql in INDEXES.values():
+        await connection.execute(sql)
+
+
+# шаги по порядку, номер шага в списке плюс один это user_version базы данных после него.
+# Новые шаги добавляются только в конец
+MIGRATIONS = [
+    create_tables,
+    add_schedule,
+    add_schedule_changes,
+    add_schedule_notifications,
+    add_show_without_marks,
+    add_class_schedule_cache,
+    fix_schedule_changes_foreign_key,
+    add_indexes,
+    add_grades_quarter,
+    add_stale_while_revalidate,
+    add_next_run,
+    fix_schedule_weeks_iso_year,
+    add_run_day,
+    drop_expiring_indexes,
+]
+
+
+async def backfill_class_ids(connection: aiosqlite.Connection, batch_size):
+    last_id = -2 ** 63
+    while True:
+        cursor = await connection.execute('SELECT id, url FROM users WHERE id>? AND class_id IS NULL '
+                                          'AND url IS NOT NULL ORDER BY id LIMIT ?', (last_id, batch_size))
+        rows = await cursor.fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        data = []
+        for user_id, url in rows:
+            try:
+                data.append((class_id_from_url(url), user_id))
+            except (IndexError, ValueError):
+                logger.warning(f'не удалось получить id класса пользователя с id {user_id} из ссылки {url}')
+        await connection.executemany('UPDATE users SET class_id=? WHERE id=?', data)
+        await connection.commit()
+        yield len(rows)
+
+
+# заполнение данных, которое может идти долго. Выполняется небольшими частями параллельно с работой бота
+BACKFILLS = [
+    backfill_class_ids,
+]
+
+
+class Migrator:
+    def __init__(self, dbfile, config: DatabaseConfig):
+        self.dbfile = dbfile
+        self.config = config
+        self._backfills_task = None
+
+    async def migrate(self):
+        async with aiosqlite.connect(self.dbfile, isolation_level=None) as connection:
+            cursor = await connection.execute('PRAGMA user_version')
+            version, = await cursor.fetchone()
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                logger.info(f'обновление базы данных до версии {number}: {migration.__name__}')
+                await connection.execute('BEGIN')
+                try:
+                    await migration(connection)
+                    await connection.execute(f'PRAGMA user_version={number}')
+                except BaseException:
+                    await connection.execute('ROLLBACK')
+                    raise
+                await connection.execute('COMMIT')
+            await create_indexes(connection)
+
+    async def start_backfills(self):
+        self._backfills_task = asyncio.create_task(self._run_backfills())
+
+    async def stop_backfills(self):
+        if self._backfills_task is not None:
+            task, self._backfills_task = self._backfills_task, None
+            task.cancel()
+            # заполнение должно закрыть своё соединение, пока цикл событий ещё работает
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def _run_backfills(self):
+        connection = await connect(self.dbfile, self.config)
+        try:
+            for backfill in BACKFILLS:
+                count = 0
+                async for processed in backfill(connection, self.config.backfill_batch_size):
+                    count += processed
+                    await asyncio.sleep(self.config.backfill_pause)
+                if count:
+                    logger.info(f'{backfill.__name__}: обработано {count} строк')
+        except Exception:
+            logger.exception('ошибка при заполнении данных в базе данных')
+        finally:
+            await connection.close()
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+from elschool_bot import MonitoringConfig
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже запланированного просыпается цикл событий.
+
+    Если какой-то обработчик долго не отдаёт управление, все остальные пользователи ждут вместе с ним.
+    """
+
+    def __init__(self, config: MonitoringConfig):
+        self.config = config
+        self._task = None
+        self.checks = 0
+        self.lag_time = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.slow_checks = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        interval = self.config.loop_lag_interval
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - start - interval)
+            self.checks += 1
+            self.lag_time += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.last_lag = lag
+            if lag >= self.config.loop_lag_warning:
+                self.slow_checks += 1
+                logger.warning(f'цикл событий был занят {lag * 1000:.0f} мс')
+
+    def stats(self):
+        return {
+            'последняя задержка, мс': round(self.last_lag * 1000, 2),
+            'средняя задержка, мс': round(self.lag_time / self.checks * 1000, 2) if self.checks else 0,
+            'максимальная задержка, мс': round(self.max_lag * 1000, 2),
+            'долгих задержек': self.slow_checks,
+        }
@@ -0,0 +1,200 @@
+import datetime
+import logging
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+logger = logging.getLogger(__name__)
+
+# парсеры BeautifulSoup от самого быстрого к самому медленному. html.parser есть всегда
+PARSERS = ('lxml', 'html.parser')
+# lxml включается только явно: одинаковость результатов проверяется на сохранённых страницах в db/pages
+DEFAULT_PARSER = 'html.parser'
+
+
+class DataProcessError(Exception):
+    pass
+
+
+def _has_class(name):
+    # при разборе SoupStrainer получает атрибут class одной строкой, а не списком
+    return re.compile(rf'(^|\s){name}(\s|$)')
+
+
+# страницы разбираются частично: в дерево попадает только нужный блок со всем содержимым,
+# навигация, скрипты и подвал пропускаются
+GRADES_TABLE = SoupStrainer('table', class_=_has_class('GradesTable'))
+RESULTS_TABLE = SoupStrainer('table', class_=_has_class('ResultsTable'))
+DIARIES_BLOCK = SoupStrainer('div', class_=_has_class('diaries'))
+LINKS = SoupStrainer('a')
+
+
+def available_parsers():
+    parsers = []
+    for parser in PARSERS:
+        try:
+            BeautifulSoup('', parser)
+        except Exception:
+            continue
+        parsers.append(parser)
+    return parsers
+
+
+def choose_parser(parser=None):
+    """Возвращает выбранный парсер, если он установлен, иначе html.parser."""
+    if parser is None:
+        return DEFAULT_PARSER
+    if parser in available_parsers():
+        return parser
+    logger.warning(f'парсер {parser} не установлен, будет использоваться {DEFAULT_PARSER}')
+    return DEFAULT_PARSER
+
+
+def parse_grades(text, parser):
+    try:
+        bs = BeautifulSoup(text, parser, parse_only=GRADES_TABLE)
+        table = bs.find('table', class_='GradesTable')
+        if not table:
+            raise DataProcessError('на странице не найдена таблица с оценками')
+        thead = table.find('thead')
+        if not thead:
+            raise DataProcessError('на странице не найден блок для заголовков')
+        ths = thead.find_all('th')
+        if not ths:
+            raise DataProcessError('на странице не найдены заголовки с названиями частей года')
+        quarters = [th.text.strip() for th in ths if not th.attrs]
+        grades = {quarter: {} for quarter in quarters}
+        if not quarters:
+            return grades
+
+        tbody = table.find('tbody')
+        if not tbody:
+            raise DataProcessError('на странице не найдено тело таблицы')
+        trs = tbody.find_all('tr')
+        if not trs:
+            raise DataProcessError('в таблице нет строк с уроками')
+        # каждая строка обходится один раз, ячейки с оценками сразу раскладываются по частям года
+        for tr in trs:
+            lesson_td = None
+            tds = []
+            for td in tr.find_all('td'):
+                classes = td.get('class', ())
+                if 'grades-marks' in classes:
+                    tds.append(td)
+                elif lesson_td is None and 'grades-lesson' in classes:
+                    lesson_td = td
+            if not lesson_td:
+                raise DataProcessError('в строке таблицы нет названия урока')
+            lesson_name = lesson_td.text.strip()
+            if not tds:
+                raise DataProcessError('в строке таблицы нет частей года')
+            if len(tds) < len(quarters):
+                raise DataProcessError('выбранной части года нет в строке таблицы')
+
+            for quarter, marks in zip(quarters, tds):
+                lesson_marks = []
+                for mark in marks.find_all('span', class_='mark-span'):
+                    lesson_date, date = mark['data-popover-content'].split('<p>')
+                    lesson_marks.append({
+                        'lesson_date': lesson_date.split(':')[1].strip(),
+                        'date': date.split(':')[1].strip(),
+                        'mark': int(mark.text)
+                    })
+                grades[quarter][lesson_name] = lesson_marks
+    except Exception as e:
+        raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
+    return grades
+
+
+def parse_results(text, parser):
+    try:
+        bs = BeautifulSoup(text, parser, parse_only=RESULTS_TABLE)
+        table = bs.find('table', class_='ResultsTable')
+        if not table:
+            raise DataProcessError('на странице не найдена таблица с оценками')
+        thead = table.find('thead')
+        if not thead:
+            raise DataProcessError('на странице не найден блок для заголовков')
+        ths = thead.find_all('th')
+        if not ths:
+            raise DataProcessError('на странице не найдены заголовки с названиями частей года')
+        quarters = [th.text.strip() for th in ths if not th.attrs][1:]
+        results = {}
+        tbody = table.find('tbody')
+        if not tbody:
+            raise DataProcessError('на странице не найдено тело таблицы')
+        trs = tbody.find_all('tr')
+        if not trs:
+            raise DataProcessError('в таблице нет строк с уроками')
+        for tr in trs:
+            lesson = tr.find('td').text.strip()
+            lesson_results = {}
+            for quarter, td in zip(quarters, tr.find_all('td', class_='results-mark')):
+                text = td.text.strip()
+                if not text:
+                    lesson_results[quarter] = None
+                else:
+                    lesson_results[quarter] = int(text)
+            results[lesson] = lesson_results
+        return results
+    except Exception as e:
+        raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
+
+
+def parse_url(text, parser):
+    bs = BeautifulSoup(text, parser, parse_only=LINKS)
+    a = bs.find('a', string='Табель')
+    if not a:
+        raise DataProcessError('на странице дневника не найдена ссылка на страницу с оценками')
+    return 'https://elschool.ru/users/diaries/' + a['href']
+
+
+def week_days(year, week):
+    """Дни недели по ISO в виде {'ДД.ММ': 'ДД.ММ.ГГГГ'}. Неделя на стыке лет содержит дни обоих годов."""
+    days = (datetime.date.fromisocalendar(year, week, weekday) for weekday in range(1, 8))
+    return {day.strftime('%d.%m'): day.strftime('%d.%m.%Y') for day in days}
+
+
+def parse_diaries(text, year, week, parser):
+    """year и week - год и неделя по ISO, на странице у дней нет года, он берётся из недели."""
+    try:
+        dates = week_days(year, week)
+        bs = BeautifulSoup(text, parser, parse_only=DIARIES_BLOCK)
+        days = {}
+        for div in bs.find('div', class_='diaries').find_all('div'):
+            table = div.find('table', class_='table')
+            if table is None:
+                continue
+            for tbody in table.find_all('tbody'):
+                trs = tbody.find_all('tr', class_='diary__lesson')
+                if not trs:
+                    continue
+                day = trs[0].find('td', class_='diary__dayweek').text.strip()
+                if '\xa0' in day:
+                    day = day.split('\xa0', 1)[1].strip()
+                else:
+                    day = day.split(' ', 1)[1]
+                day = dates.get(day, f'{day}.{year}')
+                if len(trs) == 1 and trs[0].find('td', class_='diary__nolesson') is not None:
+                    days[day] = None
+                    continue
+                lessons = {}
+                for tr in trs:
+                    td_discipline = tr.find('td', class_='diary__discipline')
+                    number, name = td_discipline.find('div', class_='flex-grow-1').text.split('. ', 1)
+                    number = int(number)
+                    start_time, end_time = (td_discipline.find('div', class_='diary__discipline__time')
+                                            .text.split('-'))
+                    homework = (tr.find('td', class_='diary__homework')
+                                .find('div', class_='diary__homework-text').text.strip())
+                    lessons[number] = {
+                        'number': number,
+                        'name': name,
+                        'start_time': start_time.strip(),
+                        'end_time': end_time.strip(),
+                        'homework': homework,
+                    }
+                days[day] = lessons
+        return days
+    except Exception as e:
+        raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
@@ -0,0 +1,227 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import time
+import typing
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from elschool_bot import PrefetchConfig
+from elschool_bot.breaker import CLOSED
+from elschool_bot.cache import RepoCache
+from elschool_bot.database import ConnectionPool
+from elschool_bot.ratelimit import TokenBucket
+from elschool_bot.repository import Repo, ElschoolRepo, RegisterError, ServerError
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Обновляет кеш оценок и расписания активных пользователей незадолго до того, как он устареет.
+
+    Тогда первое нажатие после истечения кеша не ждёт elschool, а запросы к elschool идут равномерно,
+    а не все сразу, когда пользователи что-то нажимают.
+
+    Так же заранее обновляется кеш тех, кому скоро придёт отправка по времени, чтобы в популярное время
+    все отправки пришли вовремя, а не по очереди за несколько минут.
+    """
+
+    def __init__(self, pool: ConnectionPool, elschool: ElschoolRepo, cache: RepoCache, config: PrefetchConfig,
+                 scheduler=None):
+        self.pool = pool
+        self.elschool = elschool
+        self.cache = cache
+        self.config = config
+        # notifications.scheduler.Scheduler, у него берутся ближайшие отправки
+        self.scheduler = scheduler
+        self.bucket = TokenBucket(config.rate, 1)
+        # id пользователя -> время его последнего действия
+        self._active = {}
+        # что не получилось обновить -> до какого времени больше не пробовать
+        self._skip_until = {}
+        self._task = None
+        self.grades_refreshed = 0
+        self.diaries_refreshed = 0
+        self.sends_prepared = 0
+        self.errors = 0
+        self.yielded = 0
+
+    def seen(self, user_id):
+        self._active[user_id] = time.time()
+
+    async def start(self):
+        if self.config.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            # обновление, которое сейчас идёт, должно отдать соединение до закрытия пула
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.config.interval)
+            try:
+                await self.prefetch()
+            except Exception:
+                logger.exception('не удалось заранее обновить кеш')
+
+    async def prefetch(self):
+        now = time.time()
+        self._active = {user_id: seen for user_id, seen in self._active.items()
+                        if now - seen <= self.config.active_for}
+        self._skip_until = {key: until for key, until in self._skip_until.items() if until > now}
+        jobs = await self._collect_for_sends(now)
+        if self._active:
+            date = datetime.date.today()
+            if date.isoweekday() == 7:
+                # в воскресенье уроков нет, смотреть будут уже понедельник
+                date += datetime.timedelta(days=1)
+            jobs += await self._collect(now, date)
+        if not jobs:
+            return
+        logger.debug(f'заранее обновляется кеш: {len(jobs)}')
+        # сначала то, что понадобится раньше
+        jobs.sort(key=lambda job: job[0])
+        done = set()
+        for needed_at, key, user_id, date, cache_time, for_send in jobs:
+            if key in done or (for_send and needed_at <= time.time()):
+                # отправка уже началась и сама получила оценки
+                continue
+            done.add(key)
+            while not self.bucket.take():
+                await asyncio.sleep(self.bucket.delay())
+            if self.elschool.breaker.state != CLOSED or self.elschool.limiter.queue_size():
+                # elschool не отвечает или пользователи ждут своих запросов, остальное обновится позже
+                self.yielded += 1
+                return
+            if await self._refresh(key, user_id, date, cache_time) and for_send:
+                self.sends_prepared += 1
+
+    async def _collect(self, now, date):
+        before = now + self.config.ahead
+        async with self.pool.acquire() as connection:
+            repo = Repo(connection, self.elschool, cache=self.cache)
+            grades = await repo.get_expiring_grades(before, self._active)
+            diaries = await repo.get_expiring_diaries(before, date, self._active)
+        jobs = []
+        for user_id, last_cache, cache_time in grades:
+            key = ('grades', user_id)
+            if self._need_refresh(key, user_id, now, last_cache, cache_time):
+                jobs.append((last_cache + cache_time, key, user_id, date, cache_time, False))
+        for user_id, class_id, last_cache, cache_time in diaries:
+            # расписание общее для класса, его достаточно обновить одному ученику
+            key = ('diaries', class_id, date.isocalendar()[:2])
+            if self._need_refresh(key, user_id, now, last_cache, cache_time):
+                jobs.append((last_cache + cache_time, key, user_id, date, cache_time, False))
+        return jobs
+
+    async def _collect_for_sends(self, now):
+        if self.scheduler is None:
+            return []
+        sends = self.scheduler.due_before(now + self.config.before_sends)
+        if not sends:
+            return []
+        # id пользователя -> время его ближайшей отправки оценок
+        grades_at = {}
+        # день расписания -> {id пользователя: время отправки}
+        diaries_at = {}
+        for when, user_id, id in sends:
+            if when <= now:
+                continue
+            if id == -1:
+                # отправляется расписание на следующий день
+                date = datetime.date.fromtimestamp(when) + datetime.timedelta(days=1)
+                diaries_at.setdefault(date, {}).setdefault(user_id, when)
+            else:
+                grades_at.setdefault(user_id, when)
+        if not grades_at and not diaries_at:
+            return []
+        last = sends[-1][0]
+        async with self.pool.acquire() as connection:
+            repo = Repo(connection, self.elschool, cache=self.cache)
+            grades = await repo.get_expiring_grades(last, grades_at) if grades_at else []
+            diaries = {date: await repo.get_expiring_diaries(last, date, users) for date, users in diaries_at.items()}
+        jobs = []
+        for user_id, last_cache, cache_time in grades:
+            when = grades_at.get(user_id)
+            key = ('grades', user_id)
+            if when is not None and self._need_refresh_before(key, now, when, last_cache, cache_time):
+                jobs.append((when, key, user_id, None, cache_time, True))
+        for date, rows in diaries.items():
+            for user_id, class_id, last_cache, cache_time in rows:
+                when = diaries_at[date].get(user_id)
+                key = ('diaries', class_id, date.isocalendar()[:2])
+                if when is not None and self._need_refresh_before(key, now, when, last_cache, cache_time):
+                    jobs.append((when, key, user_id, date, cache_time, True))
+        return jobs
+
+    def _need_refresh(self, key, user_id, now, last_cache, cache_time):
+        # при маленьком времени кеширования не обновляем чаще, чем через половину этого времени
+        return (user_id in self._active and key not in self._skip_until
+                and now - last_cache >= cache_time / 2)
+
+    def _need_refresh_before(self, key, now, when, last_cache, cache_time):
+        # кеш устареет к отправке, а обновлённый сейчас ещё будет действовать.
+        # Если время кеширования меньше, чем осталось до отправки, обновляем позже
+        return key not in self._skip_until and last_cache + cache_time < when and now + cache_time > when
+
+    async def _refresh(self, key, user_id, date, cache_time):
+        try:
+            async with self.pool.lease() as connection:
+                repo = Repo(connection, self.elschool, cache=self.cache)
+                if key[0] == 'grades':
+                    await repo.update_cache(user_id)
+                    self.grades_refreshed += 1
+                else:
+                    await repo.update_diaries_cache(user_id, date)
+                    self.diaries_refreshed += 1
+            return True
+        except ServerError as e:
+            # elschool временно не отвечает или размыкатель не пустил запрос. Это не повод
+            # не обновлять кеш до конца его жизни, попробуем снова немного позже
+            self.errors += 1
+            backoff = min(cache_time, max(self.config.error_backoff, e.retry_after))
+            self._skip_until[key] = time.time() + backoff
+            logger.info(f'не удалось заранее обновить кеш пользователя с id {user_id}, '
+                        f'следующая попытка через {backoff:.0f} с: {e}')
+        except RegisterError as e:
+            # например, устарел токен. Пользователь узнает об этом, когда сам что-то запросит
+            self.errors += 1
+            self._skip_until[key] = time.time() + cache_time
+            logger.info(f'не удалось заранее обновить кеш пользователя с id {user_id}: {e}')
+        except Exception:
+            self.errors += 1
+            self._skip_until[key] = time.time() + cache_time
+            logger.exception(f'не удалось заранее обновить кеш пользователя с id {user_id}')
+
+    def stats(self):
+        return {
+            'активных пользователей': len(self._active),
+            'обновлено оценок': self.grades_refreshed,
+            'обновлено расписаний': self.diaries_refreshed,
+            'подготовлено отправок по времени': self.sends_prepared,
+            'ошибок': self.errors,
+            'уступил место пользователям': self.yielded,
+        }
+
+
+class PrefetchMiddleware(BaseMiddleware):
+    """Запоминает, кто пользуется ботом, чтобы заранее обновлять только их кеш."""
+
+    def __init__(self, prefetcher: Prefetcher):
+        self.prefetcher = prefetcher
+
+    async def __call__(self, handler: typing.Callable[[TelegramObject, typing.Dict[str, typing.Any]],
+                                                      typing.Awaitable[typing.Any]],
+                       event: TelegramObject,
+                       data: typing.Dict[str, typing.Any]) -> typing.Any:
+        user = data.get('event_from_user')
+        if user is not None:
+            self.prefetcher.seen(user.id)
+        return await handler(event, data)
@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueTimeout(Exception):
+    """Запрос не дождался своей очереди за отведённое время."""
+
+
+class TokenBucket:
+    """Разрешает не больше rate действий в секунду, но позволяет накопить до capacity штук подряд.
+
+    Если rate равен None, ограничения нет.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        if self.rate is None:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """Сколько секунд осталось до появления следующего разрешения."""
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self):
+        if self.rate is None:
+            return True
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def pause(self, seconds):
+        """Не выдаёт разрешений ближайшие seconds секунд."""
+        if self.rate is None:
+            return
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class RequestLimiter:
+    """Ограничивает частоту и количество одновременных запросов.
+
+    Ожидающие запросы разных пользователей пропускаются по очереди,
+    поэтому пользователь с кучей запросов не задерживает остальных.
+    """
+
+    def __init__(self, rate, burst, max_concurrency):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        # ключ пользователя -> его ожидающие запросы, порядок ключей это очередь обхода
+        self._queues = collections.OrderedDict()
+        self._timer = None
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.max_queue_size = 0
+        self.timeouts = 0
+
+    def queue_size(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _try_start(self):
+        if self.active >= self.max_concurrency or not self.bucket.take():
+            return False
+        self.active += 1
+        return True
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            if queue[0].done():
+                # запрос отменили в том же шаге цикла событий, и он ещё не успел убрать себя из очереди
+                queue.popleft()
+                if not queue:
+                    del self._queues[key]
+                continue
+            if not self._try_start():
+                break
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            future.set_result(None)
+        if self._queues and self.active < self.max_concurrency:
+            # место есть, но разрешения закончились, ждём следующее
+            self._timer = asyncio.get_running_loop().call_later(self.bucket.delay(), self._dispatch)
+
+    def _forget(self, key, future):
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        with contextlib.suppress(ValueError):
+            queue.remove(future)
+        if not queue:
+            del self._queues[key]
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, key, timeout=None):
+        """Ждёт места для запроса, но не дольше timeout секунд, если он указан."""
+        start = time.monotonic()
+        if self._queues or not self._try_start():
+            future = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(key, collections.deque()).append(future)
+            self.waits += 1
+            self.max_queue_size = max(self.max_queue_size, self.queue_size())
+            logger.debug(f'запрос ждёт в очереди, перед ним {self.queue_size() - 1}')
+            self._dispatch()
+            try:
+                await asyncio.wait_for(future, timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+                if future.done() and not future.cancelled():
+                    # место уже выдали, но запрос отменили, отдаём его следующему
+                    self._release()
+                else:
+                    self._forget(key, future)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                    raise QueueTimeout(f'запрос ждал в очереди дольше {timeout:.1f} с') from None
+                raise
+        wait_time = time.monotonic() - start
+        self.requests += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        return {
+            'выполняется запросов': self.active,
+            'в очереди': self.queue_size(),
+            'максимальная очередь': self.max_queue_size,
+            'всего запросов': self.requests,
+            'ожиданий в очереди': self.waits,
+            'не дождались очереди': self.timeouts,
+            'среднее ожидание, мс': round(self.wait_time / self.requests * 1000, 2) if self.requests else 0,
+            'максимальное ожидание, мс': round(self.max_wait_time * 1000, 2),
+        }
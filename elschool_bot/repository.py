@@ -1,5 +1,14 @@
+import asyncio
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import copy
+import dataclasses
 import datetime
+import json
 import logging
+import multiprocessing
 import random
 import time
 import typing
@@ -9,27 +18,85 @@ import aiohttp
 import aiosqlite
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
-from bs4 import BeautifulSoup
+from elschool_bot import ElschoolConfig, CacheConfig
+from elschool_bot.cache import MISSING, RepoCache
+from elschool_bot.database import ConnectionPool, PooledConnection
+from elschool_bot.breaker import CircuitBreaker
+from elschool_bot.ratelimit import QueueTimeout, RequestLimiter
+from elschool_bot.parsing import (DataProcessError, choose_parser, parse_grades, parse_results, parse_url,
+                                  parse_diaries)
 
 logger = logging.getLogger(__name__)
 
+# ответы, после которых запрос стоит повторить: сервер перегружен или временно недоступен
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# ошибки соединения, после которых запрос стоит повторить
+RETRY_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+# сколько хранится расписание недели, которую давно никто из класса не смотрел
+SCHEDULE_CACHE_LIFETIME = 7 * 24 * 60 * 60
+
+# столбцы users, которые Repo читает через _get_user
+USER_COLUMNS = ('jwtoken', 'url', 'class_id', 'quarter', 'login', 'password', 'last_cache', 'cache_time',
+                'stale_while_revalidate', 'autosend_schedule_time', 'autosend_schedule_interval',
+                'notify_change_schedule')
+
 
 class Repo:
-    def __init__(self, connection: aiosqlite.Connection):
+    def __init__(self, connection: typing.Union[aiosqlite.Connection, PooledConnection], elschool: 'ElschoolRepo',
+                 refresher: 'Refresher' = None, cache: RepoCache = None):
         self.db = connection
+        self.elschool = elschool
+        self.refresher = refresher
+        # без общего кеша каждый Repo читает всё из базы данных
+        self.cache = cache if cache is not None else RepoCache(CacheConfig(users=0, grades=0))
+        # время сохранения данных, которые пришлось отдать из кеша, потому что elschool не ответил
+        self.stale_since = None
+        # фоновое обновление, запущенное вместо ожидания новых данных. Его результат это новые данные,
+        # если они отличаются от отданных, или None
+        self.refreshing: typing.Optional[asyncio.Task] = None
+
+    def stale_warning(self):
+        """Предупреждение для пользователя, если данные взяты из кеша, потому что elschool не отвечает."""
+        if self.stale_since is None:
+            return ''
+        if not self.stale_since:
+            return 'elschool сейчас не отвечает, поэтому показываю сохранённые данные'
+        # время показывается как в остальном боте, по Екатеринбургу
+        saved = datetime.datetime.fromtimestamp(self.stale_since, datetime.timezone(datetime.timedelta(hours=5)))
+        return f'elschool сейчас не отвечает, поэтому показываю данные, сохранённые {saved:%d.%m.%Y в %H:%M}'
+
+    async def _elschool(self, request: typing.Awaitable):
+        """Ждёт запрос к elschool. Соединение из пула на это время отдаётся другим,
+        поэтому запрос не должен идти посреди транзакции или открытого курсора."""
+        if isinstance(self.db, PooledConnection):
+            await self.db.release()
+        return await request
+
+    async def _get_user(self, user_id):
+        """Строка пользователя из users словарём или None, если его нет. Словарь общий, менять его нельзя."""
+        user = self.cache.users.get(user_id)
+        if user is not MISSING:
+            return user
+        generation = self.cache.generation
+        cursor = await self.db.execute(f'SELECT {", ".join(USER_COLUMNS)} FROM users WHERE id=?', (user_id,))
+        row = await cursor.fetchone()
+        user = dict(zip(USER_COLUMNS, row)) if row is not None else None
+        if self.cache.generation == generation:
+            self.cache.users.set(user_id, user)
+        return user
 
     async def has_user(self, user_id):
-        cursor = await self.db.execute('SELECT EXISTS(SELECT id FROM users WHERE id=?)', (user_id,))
-        return (await cursor.fetchone())[0]
+        return await self._get_user(user_id) is not None
 
     async def get_user_data(self, user_id):
-        cursor = await self.db.execute('SELECT login, password FROM users WHERE id=?',
-                                       (user_id,))
-        return await cursor.fetchone()
+        user = await self._get_user(user_id)
+        if user is None:
+            return None
+        return user['login'], user['password']
 
     async def check_register_user(self, login, password):
-        elschool = ElschoolRepo()
-        return await elschool.register(login, password)
+        return await self._elschool(self.elschool.register(login, password))
 
     async def register_user(self, user_id, jwtoken, url, quarter, login=None, password=None):
         class_id = self._class_id_from_url(url)
@@ -37,35 +104,59 @@ class Repo:
             'INSERT INTO users (id, jwtoken, url, class_id, quarter, login, password) VALUES (?, ?, ?, ?, ?, ?, ?)',
             (user_id, jwtoken, url, class_id, quarter, login, password))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
         logger.info(f'пользователь с id {user_id} зарегистрировался')
 
     async def update_data(self, user_id, jwtoken, login=None, password=None):
         await self.db.execute('UPDATE users SET jwtoken=?, login=?, password=?, url=NULL, last_cache=0 WHERE id=?',
                               (jwtoken, login, password, user_id))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
         logger.info(f'пользователь с id {user_id} обновил свои данные')
 
     async def get_user_data_jwtoken(self, user_id):
-        cursor = await self.db.execute('SELECT login, password, jwtoken FROM users WHERE id=?',
-                                       (user_id,))
-        return await cursor.fetchone()
-
-    async def get_grades(self, user_id):
+        user = await self._get_user(user_id)
+        if user is None:
+            return None
+        return user['login'], user['password'], user['jwtoken']
+
+    async def get_grades(self, user_id, allow_stale=False):
+        """allow_stale разрешает сразу отдать устаревшие оценки и обновить их в фоне,
+        если пользователь так настроил. Тогда фоновое обновление будет в self.refreshing."""
         logger.debug(f'пользователь с id {user_id} получает оценки')
-        async with self.db.cursor() as cursor:
-            cursor = typing.cast(aiosqlite.Cursor, cursor)
-            await cursor.execute('SELECT last_cache, cache_time, quarter, jwtoken, url FROM users WHERE id=?',
-                                 (user_id,))
-            last_cache, cache_time, quarter, jwtoken, url = await cursor.fetchone()
-            if time.time() - last_cache > cache_time:
-                logger.debug('время кеширования прошло, нужно получить новые оценки')
-                return await self._update_cache(cursor, user_id, quarter, jwtoken, url)
-
-            logger.debug('время кеширования ещё не прошло, отправляются сохранённые оценки')
-            await cursor.execute('SELECT lesson_name, lesson_date, date, mark FROM grades WHERE user_id=?',
-                                 (user_id,))
+        user = await self._get_user(user_id)
+        last_cache, quarter, jwtoken, url = user['last_cache'], user['quarter'], user['jwtoken'], user['url']
+        if time.time() - last_cache > user['cache_time']:
+            if allow_stale and user['stale_while_revalidate'] and self.refresher is not None:
+                grades = await self._get_cached_grades(user_id, quarter)
+                if grades:
+                    logger.debug('отправляются сохранённые оценки, новые получаются в фоне')
+                    self.refreshing = self.refresher.start(('grades', user_id),
+                                                           lambda repo: repo.refresh_grades(user_id))
+                    return grades
+            logger.debug('время кеширования прошло, нужно получить новые оценки')
+            try:
+                grades, _ = await self._update_cache(user_id, jwtoken, url)
+            except ServerError:
+                grades = await self._get_cached_grades(user_id, quarter)
+                if not grades:
+                    raise
+                logger.info(f'elschool не отвечает, пользователь с id {user_id} получает сохранённые оценки')
+                self.stale_since = last_cache
+                return grades
+            return select_quarter(grades, quarter)
+
+        logger.debug('время кеширования ещё не прошло, отправляются сохранённые оценки')
+        return await self._get_cached_grades(user_id, quarter)
+
+    async def _get_cached_grades(self, user_id, quarter):
+        cached = self.cache.grades.get(user_id)
+        if cached is MISSING or cached[0] != quarter:
+            generation = self.cache.generation
+            rows = await self.db.execute_fetchall('SELECT lesson_name, lesson_date, date, mark FROM grades '
+                                                  'WHERE user_id=? AND quarter=?', (user_id, quarter))
             grades = {}
-            async for lesson_name, lesson_date, date, mark in cursor:
+            for lesson_name, lesson_date, date, mark in rows:
                 if lesson_name not in grades:
                     grades[lesson_name] = []
                 grades[lesson_name].append({
@@ -73,62 +164,132 @@ class Repo:
                     'date': date,
                     'mark': mark
                 })
-            return grades
-
-    async def update_cache(self, user_id):
-        async with self.db.cursor() as cursor:
-            await cursor.execute('SELECT quarter, jwtoken, url FROM users WHERE id=?', (user_id,))
-            quarter, jwtoken, url = await cursor.fetchone()
-            return self._update_cache(cursor, user_id, quarter, jwtoken, url)
+            if self.cache.generation == generation:
+                self.cache.grades.set(user_id, (quarter, grades))
+        else:
+            grades = cached[1]
+        # диалоги могут менять полученные оценки, а сохранённые должны остаться как есть
+        return {lesson_name: [dict(mark) for mark in marks] for lesson_name, marks in grades.items()}
+
+    async def refresh_grades(self, user_id):
+        """Обновляет кеш оценок. Возвращает оценки выбранной части года, если в ней что-то изменилось, иначе None."""
+        user = await self._get_user(user_id)
+        quarter = user['quarter']
+        grades, diff = await self._update_cache(user_id, user['jwtoken'], user['url'])
+        if quarter in diff.added or quarter in diff.removed:
+            return select_quarter(grades, quarter)
+        return None
+
+    async def get_stale_while_revalidate(self, user_id):
+        user = await self._get_user(user_id)
+        return bool(user and user['stale_while_revalidate'])
+
+    async def set_stale_while_revalidate(self, user_id, stale_while_revalidate):
+        await self.db.execute('UPDATE users SET stale_while_revalidate=? WHERE id=?',
+                              (stale_while_revalidate, user_id))
+        await self.db.commit()
+        self.cache.invalidate_user(user_id)
+
+    async def update_cache(self, user_id) -> 'GradesDiff':
+        user = await self._get_user(user_id)
+        _, diff = await self._update_cache(user_id, user['jwtoken'], user['url'])
+        return diff
+
+    async def get_expiring_grades(self, before, user_ids):
+        """Пользователи из user_ids, у которых кеш оценок устареет раньше before: id, last_cache, cache_time."""
+        # пользователи передаются списком json, так запрос читает только их строки, сколько бы всего их ни было
+        cursor = await self.db.execute('SELECT id, last_cache, cache_time FROM users '
+                                       'WHERE id IN (SELECT value FROM json_each(?)) '
+                                       'AND jwtoken IS NOT NULL AND last_cache + cache_time < ?',
+                                       (json.dumps(list(user_ids)), before))
+        return await cursor.fetchall()
 
     async def set_cache_time(self, user_id, cache_time):
         await self.db.execute('UPDATE users SET cache_time=? WHERE id=?', (cache_time, user_id))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
 
-    async def _update_cache(self, cursor: aiosqlite.Cursor, user_id, quarter, jwtoken, url):
-        elschool = ElschoolRepo()
+    async def _update_cache(self, user_id, jwtoken, url):
+        """Получает оценки за все части года и сохраняет в кеш только изменения."""
+        user_changed = not url
         if url:
-            grades = await elschool.get_grades(jwtoken, url, quarter)
-            await cursor.execute('UPDATE users SET last_cache=? WHERE id=?', (time.time(), user_id))
+            grades = await self._elschool(self.elschool.get_grades(jwtoken, url, None))
         else:
-            grades, url = await elschool.get_grades_and_url(jwtoken, quarter)
-            class_id = self._class_id_from_url(url)
-            await cursor.execute('UPDATE users SET last_cache=?, url=?, class_id=? WHERE id=?',
-                                 (time.time(), url, class_id, user_id))
-        data = []
-        for name, marks in grades.items():
-            if not marks:
-                data.append((user_id, name, '00.00.0000', '00.00.0000', 0))
-            for mark in marks:
-                data.append((user_id, name, mark['lesson_date'], mark['date'], mark['mark']))
-
-        await cursor.execute('DELETE FROM grades WHERE user_id=?', (user_id,))
-        await cursor.executemany('INSERT INTO grades VALUES (?, ?, ?, ?, ?)', data)
-        await self.db.commit()
+            grades, url = await self._elschool(self.elschool.get_grades_and_url(jwtoken))
+        new_rows = collections.Counter()
+        for quarter, quarter_grades in grades.items():
+            for name, marks in quarter_grades.items():
+                if not marks:
+                    new_rows[(quarter, name, '00.00.0000', '00.00.0000', 0)] += 1
+                for mark in marks:
+                    new_rows[(quarter, name, mark['lesson_date'], mark['date'], mark['mark'])] += 1
+
+        async with self.db.cursor() as cursor:
+            if user_changed:
+                await cursor.execute('UPDATE users SET last_cache=?, url=?, class_id=? WHERE id=?',
+                                     (time.time(), url, self._class_id_from_url(url), user_id))
+            else:
+                await cursor.execute('UPDATE users SET last_cache=? WHERE id=?', (time.time(), user_id))
+            await cursor.execute('SELECT rowid, quarter, lesson_name, lesson_date, date, mark FROM grades '
+                                 'WHERE user_id=?', (user_id,))
+            rowids = collections.defaultdict(list)
+            async for rowid, *row in cursor:
+                rowids[tuple(row)].append(rowid)
+            old_rows = collections.Counter({row: len(ids) for row, ids in rowids.items()})
+
+            added = new_rows - old_rows
+            removed = old_rows - new_rows
+            await cursor.executemany('DELETE FROM grades WHERE rowid=?',
+                                     [(rowid,) for row, count in removed.items() for rowid in rowids[row][:count]])
+            await cursor.executemany('INSERT INTO grades (user_id, quarter, lesson_name, lesson_date, date, mark) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)',
+                                     [(user_id, *row) for row in added.elements()])
+            await self.db.commit()
+        self.cache.invalidate_user(user_id)
+        self.cache.invalidate_grades(user_id)
+        diff = GradesDiff(self._diff_grades(added), self._diff_grades(removed))
+        if diff:
+            logger.debug(f'у пользователя с id {user_id} изменились оценки: {diff}')
+        return grades, diff
+
+    def _diff_grades(self, rows: collections.Counter):
+        grades = {}
+        for quarter, name, lesson_date, date, mark in rows.elements():
+            if mark == 0:
+                # строка-заглушка для урока без оценок
+                continue
+            quarter_grades = grades.setdefault(quarter, {})
+            quarter_grades.setdefault(name, []).append({'lesson_date': lesson_date, 'date': date, 'mark': mark})
         return grades
 
     async def clear_cache(self, user_id):
         await self.db.execute('UPDATE users SET last_cache=0 WHERE id=?', (user_id,))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
 
     async def check_get_grades(self, jwtoken):
-        elschool = ElschoolRepo()
-        return await elschool.get_grades_and_url(jwtoken)
+        return await self._elschool(self.elschool.get_grades_and_url(jwtoken))
 
     async def delete_data(self, user_id):
         await self.db.execute('DELETE FROM users WHERE id=?', (user_id,))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
+        self.cache.invalidate_grades(user_id)
 
     async def get_quarters(self, user_id):
-        elschool = ElschoolRepo()
-        cursor = await self.db.execute('SELECT jwtoken, url FROM users WHERE id=?', (user_id,))
-        jwtoken, url = await cursor.fetchone()
-        grades = await elschool.get_grades(jwtoken, url, None)
+        # строки каждой части года добавляются в порядке таблицы, поэтому порядок частей года сохраняется
+        rows = await self.db.execute_fetchall('SELECT quarter FROM grades WHERE user_id=? GROUP BY quarter '
+                                              'ORDER BY MIN(rowid)', (user_id,))
+        if rows:
+            return [quarter for quarter, in rows]
+        user = await self._get_user(user_id)
+        grades, _ = await self._update_cache(user_id, user['jwtoken'], user['url'])
         return list(grades.keys())
 
     async def update_quarter(self, user_id, quarter):
         await self.db.execute('UPDATE users SET quarter=? WHERE id=?', (quarter, user_id))
-        await self.clear_cache(user_id)
+        await self.db.commit()
+        self.cache.invalidate_user(user_id)
 
     async def save_schedule(self, user_id, name, next_time, interval,
                             show_mode, lessons, dates, marks, show_without_marks):
@@ -144,7 +305,8 @@ class Repo:
                 name = f'отправка {id}'
             logger.info(f'пользователь с id {user_id} сохранил отправку с id {id} и названием {name}, '
                         f'которая покажет оценки в {next_time} с повторениями {interval}')
-            await cursor.execute('INSERT INTO schedules VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            await cursor.execute('INSERT INTO schedules (user_id, id, name, next_time, interval, show_mode, lessons, '
+                                 'dates, marks, show_without_marks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
                                  (user_id, id, name, next_time, interval,
                                   show_mode, lessons, dates, marks, show_without_marks))
         await self.db.commit()
@@ -170,47 +332,66 @@ class Repo:
         await self.db.commit()
 
     async def get_schedule(self, user_id, id):
-        cursor = await self.db.execute('SELECT * FROM schedules WHERE user_id=? AND id=?', (user_id, id))
+        cursor = await self.db.execute('SELECT user_id, id, name, next_time, interval, show_mode, lessons, dates, '
+                                       'marks, show_without_marks FROM schedules WHERE user_id=? AND id=?',
+                                       (user_id, id))
         return await cursor.fetchone()
 
     async def get_schedules_for_restore(self):
-        cursor = await self.db.execute('SELECT user_id, id, next_time FROM schedules')
-        schedules = {}
-        async for user_id, id, next_time in cursor:
-            if user_id not in schedules:
-                schedules[user_id] = []
-            schedules[user_id].append({'id': id, 'next_time': next_time})
-
-        cursor = await self.db.execute('SELECT id, autosend_schedule_time FROM users WHERE autosend_schedule_time!=NULL')
-        async for user_id, time in cursor:
-            if user_id not in schedules:
-                schedules[user_id] = []
-            schedules[user_id].append({'id': -1, 'next_time': time})
+        """Все отправки: user_id, id, next_time, interval, next_run, run_day. Отправка расписания имеет id -1."""
+        cursor = await self.db.execute('SELECT user_id, id, next_time, interval, next_run, run_day FROM schedules')
+        schedules = list(await cursor.fetchall())
+        cursor = await self.db.execute('SELECT id, -1, autosend_schedule_time, autosend_schedule_interval, '
+                                       'autosend_schedule_next_run, autosend_schedule_run_day FROM users '
+                                       'WHERE autosend_schedule_time IS NOT NULL')
+        schedules += await cursor.fetchall()
         return schedules
 
+    async def set_next_runs(self, next_runs):
+        """Сохраняет время следующих отправок, next_runs это список (user_id, id, next_run, run_day)."""
+        await self.db.executemany('UPDATE schedules SET next_run=?, run_day=? WHERE user_id=? AND id=?',
+                                  [(next_run, run_day, user_id, id)
+                                   for user_id, id, next_run, run_day in next_runs if id != -1])
+        await self.db.executemany('UPDATE users SET autosend_schedule_next_run=?, autosend_schedule_run_day=? '
+                                  'WHERE id=?',
+                                  [(next_run, run_day, user_id)
+                                   for user_id, id, next_run, run_day in next_runs if id == -1])
+        await self.db.commit()
+
+    async def remove_expired_schedules(self, keys):
+        """Удаляет одноразовые отправки, которые опоздали так сильно, что уже не выполнятся.
+        keys это список (user_id, id), у отправки расписания выключается автоотправка."""
+        await self.db.executemany('DELETE FROM schedules WHERE user_id=? AND id=?',
+                                  [(user_id, id) for user_id, id in keys if id != -1])
+        await self.db.executemany('UPDATE users SET autosend_schedule_time=NULL, autosend_schedule_interval=-1, '
+                                  'autosend_schedule_next_run=NULL WHERE id=?',
+                                  [(user_id,) for user_id, id in keys if id == -1])
+        await self.db.commit()
+        for user_id, id in keys:
+            if id == -1:
+                self.cache.invalidate_user(user_id)
+
     async def get_results(self, user_id):
-        cursor = await self.db.execute('SELECT jwtoken, url FROM users WHERE id=?', (user_id,))
-        jwtoken, url = await cursor.fetchone()
-        elschool = ElschoolRepo()
+        user = await self._get_user(user_id)
+        jwtoken, url = user['jwtoken'], user['url']
         if url:
-            return await elschool.get_results(jwtoken, url)
+            return await self._elschool(self.elschool.get_results(jwtoken, url))
         else:
-            results, url = await elschool.get_results_and_url(jwtoken)
+            results, url = await self._elschool(self.elschool.get_results_and_url(jwtoken))
             class_id = self._class_id_from_url(url)
             await self.db.execute('UPDATE users SET url=?, class_id=? WHERE id=?', (url, class_id, user_id))
             await self.db.commit()
+            self.cache.invalidate_user(user_id)
             return results
 
-    async def get_diaries(self, user_id, date: datetime.date):
+    async def get_diaries(self, user_id, date: datetime.date, allow_stale=False):
+        """allow_stale работает как в get_grades."""
         if date.isocalendar()[2] == 7:
             return 'в этот день нет расписания. Тебе оно зачем понадобилось?'
-        async with self.db.cursor() as cursor:
-            diaries = await self._get_diaries(cursor, user_id, date)
-            default_changes = await self._get_diaries_changes(cursor, user_id, date.isocalendar()[2])
-            changes = await self._get_diaries_changes(cursor, user_id, self._as_timestamp(date))
-            self._apply_diaries_changes(default_changes, diaries)
-            self._apply_diaries_changes(changes, diaries)
-            return diaries
+        diaries, default_changes, changes = await self._get_diaries(user_id, date, allow_stale)
+        self._apply_diaries_changes(default_changes, diaries)
+        self._apply_diaries_changes(changes, diaries)
+        return diaries
 
     def _apply_diaries_changes(self, changes, diaries):
         for change in changes:
@@ -234,80 +415,173 @@ class Repo:
 
     async def check_class_id(self, class_id, user_id, need_commit=True):
         if class_id is None:
-            cursor = await self.db.execute('SELECT url FROM users WHERE id=?', (user_id,))
-            url, = await cursor.fetchone()
+            url = (await self._get_user(user_id))['url']
             class_id = self._class_id_from_url(url)
             await self.db.execute('UPDATE users SET class_id=? WHERE id=?', (class_id, user_id))
             if need_commit:
                 await self.db.commit()
+            self.cache.invalidate_user(user_id)
         return class_id
 
-    async def _get_diaries_changes(self, cursor: aiosqlite.Cursor, user_id, timestamp):
-        await cursor.execute('SELECT class_id FROM users WHERE id=?', (user_id,))
-        class_id = await self.check_class_id((await cursor.fetchone())[0], user_id)
-        await cursor.execute('SELECT number, name, start_time, end_time, homework, remove FROM schedule_changes '
-                             'WHERE class_id=? AND date=?', (class_id, timestamp))
-        changes = list(await cursor.fetchall())
-        changes = [{
-            'number': number,
-            'name': name,
-            'start_time': start_time,
-            'end_time': end_time,
-            'homework': homework,
-            'remove': remove
-        } for number, name, start_time, end_time, homework, remove in changes]
-        return changes
-
-    async def _get_diaries(self, cursor, user_id, date: datetime.date):
-        await cursor.execute('SELECT schedule_last_cache, cache_time, jwtoken, url FROM users WHERE id=?',
-                             (user_id,))
-        last_cache, cache_time, jwtoken, url = await cursor.fetchone()
-        if time.time() - last_cache > cache_time:
-            logger.debug('время кеширования прошло, нужно получить новое')
-            return await self._update_diaries_cache(cursor, user_id, jwtoken, url, date)
-
-        await cursor.execute('SELECT number, name, start_time, end_time, homework '
-                             'FROM schedule_cache WHERE user_id=? AND date=?',
-                             (user_id, date.strftime('%d.%m.%Y')))
-        diaries = {
-            number: {
+    async def _get_diaries_changes(self, user_id, date: datetime.date):
+        class_id = await self.check_class_id((await self._get_user(user_id))['class_id'], user_id)
+        rows = await self.db.execute_fetchall('SELECT number, name, start_time, end_time, homework, remove, date '
+                                              'FROM schedule_changes WHERE class_id=? AND date IN (?, ?)',
+                                              (class_id, date.isocalendar()[2], self._as_timestamp(date)))
+        return self._split_diaries_changes(rows, date)
+
+    def _split_diaries_changes(self, rows, date: datetime.date):
+        """Делит строки schedule_changes на изменения для дня недели и для конкретной даты."""
+        weekday = date.isocalendar()[2]
+        default_changes = []
+        changes = []
+        for number, name, start_time, end_time, homework, remove, change_date in rows:
+            (default_changes if change_date == weekday else changes).append({
                 'number': number,
                 'name': name,
-                'homework': homework,
                 'start_time': start_time,
                 'end_time': end_time,
-            } async for number, name, start_time, end_time, homework in cursor
-        }
+                'homework': homework,
+                'remove': remove
+            })
+        return default_changes, changes
+
+    async def _get_diaries(self, user_id, date: datetime.date, allow_stale=False):
+        """Возвращает расписание на date из кеша или elschool и изменения для дня недели и для даты."""
+        user = await self._get_user(user_id)
+        cache_time, jwtoken, url, class_id = user['cache_time'], user['jwtoken'], user['url'], user['class_id']
+        stale_while_revalidate = user['stale_while_revalidate']
+        if not url:
+            diaries = await self._update_diaries_cache(user_id, jwtoken, url, date)
+            return (diaries, *await self._get_diaries_changes(user_id, date))
 
-        if not diaries:
-            return await self._update_diaries_cache(cursor, user_id, jwtoken, url, date)
+        class_id = await self.check_class_id(class_id, user_id)
+        year, week = self._week(date)
+        # время сохранения недели, уроки дня и изменения читаются одним запросом, первый столбец это вид строки
+        rows = await self.db.execute_fetchall(
+            'SELECT 0, last_cache, NULL, NULL, NULL, NULL, NULL, NULL FROM class_schedule_weeks '
+            'WHERE class_id=:class_id AND year=:year AND week=:week '
+            'UNION ALL '
+            'SELECT 1, number, name, start_time, end_time, homework, NULL, NULL FROM class_schedule_cache '
+            'WHERE class_id=:class_id AND date=:day '
+            'UNION ALL '
+            'SELECT 2, number, name, start_time, end_time, homework, remove, date FROM schedule_changes '
+            'WHERE class_id=:class_id AND date IN (:weekday, :timestamp)',
+            {'class_id': class_id, 'year': year, 'week': week, 'day': date.strftime('%d.%m.%Y'),
+             'weekday': date.isocalendar()[2], 'timestamp': self._as_timestamp(date)})
+        last_cache = None
+        diaries = {}
+        change_rows = []
+        for kind, *row in rows:
+            if kind == 0:
+                last_cache = row[0]
+            elif kind == 1:
+                number, name, start_time, end_time, homework = row[:5]
+                diaries[number] = {
+                    'number': number,
+                    'name': name,
+                    'homework': homework,
+                    'start_time': start_time,
+                    'end_time': end_time,
+                }
+            else:
+                change_rows.append(row)
+        default_changes, changes = self._split_diaries_changes(change_rows, date)
+
+        expired = last_cache is None or time.time() - last_cache > cache_time
+        # без сохранённой недели отдавать нечего, её приходится ждать
+        refresh = (expired and last_cache is not None and allow_stale and stale_while_revalidate
+                   and self.refresher is not None)
+        if refresh:
+            logger.debug('отправляется сохранённое расписание, новое получается в фоне')
+        elif expired:
+            logger.debug('время кеширования прошло, нужно получить новое')
+            try:
+                diaries = await self._update_diaries_cache(user_id, jwtoken, url, date)
+                return diaries, default_changes, changes
+            except ServerError:
+                if last_cache is None:
+                    raise
+                logger.info(f'elschool не отвечает, пользователь с id {user_id} получает сохранённое расписание')
+                self.stale_since = last_cache
+
+        # неделя уже получена, значит в этот день просто нет уроков
+        diaries = diaries or None
+        if refresh:
+            # к отданному расписанию ещё применятся изменения, поэтому сравнивать нужно с копией
+            old_diaries = copy.deepcopy(diaries)
+            self.refreshing = self.refresher.start(('diaries', user_id, date),
+                                                   lambda repo: repo.refresh_diaries(user_id, date, old_diaries))
+        return diaries, default_changes, changes
+
+    async def refresh_diaries(self, user_id, date: datetime.date, old_diaries):
+        """Обновляет кеш расписания. Возвращает расписание на date вместе с изменениями,
+        если на elschool оно отличается от old_diaries, иначе None."""
+        user = await self._get_user(user_id)
+        diaries = await self._update_diaries_cache(user_id, user['jwtoken'], user['url'], date)
+        if diaries == old_diaries:
+            return None
+        return await self.get_diaries(user_id, date)
+
+    async def get_expiring_diaries(self, before, date: datetime.date, user_ids):
+        """Пользователи из user_ids, у которых сохранённое расписание на неделю с date устареет раньше before:
+        id, class_id, last_cache недели, cache_time."""
+        year, week = self._week(date)
+        # CROSS JOIN не даёт sqlite начать с недель всех классов: сначала пользователи по id, потом их недели
+        cursor = await self.db.execute(
+            'SELECT users.id, users.class_id, class_schedule_weeks.last_cache, users.cache_time FROM users '
+            'CROSS JOIN class_schedule_weeks ON class_schedule_weeks.class_id=users.class_id '
+            'WHERE users.id IN (SELECT value FROM json_each(?)) AND year=? AND week=? '
+            'AND users.jwtoken IS NOT NULL AND users.url IS NOT NULL '
+            'AND class_schedule_weeks.last_cache + users.cache_time < ?',
+            (json.dumps(list(user_ids)), year, week, before))
+        return await cursor.fetchall()
 
-        return diaries
+    async def update_diaries_cache(self, user_id, date: datetime.date):
+        user = await self._get_user(user_id)
+        await self._update_diaries_cache(user_id, user['jwtoken'], user['url'], date)
+
+    def _week(self, date: datetime.date):
+        # год берётся по ISO, иначе 30.12.2024 и 01.01.2024 попадут в одну неделю 1 2024 года
+        return tuple(date.isocalendar()[:2])
 
     def _class_id_from_url(self, url):
-        return int(url.lower().split('departmentid')[1].split('&')[0][1:])
+        return class_id_from_url(url)
 
-    async def _update_diaries_cache(self, cursor: aiosqlite.Cursor, user_id, jwtoken, url, date):
-        elschool = ElschoolRepo()
+    async def _update_diaries_cache(self, user_id, jwtoken, url, date):
+        user_changed = not url
         if url:
-            diaries = await elschool.get_diaries(jwtoken, url, date)
-            await cursor.execute('UPDATE users SET schedule_last_cache=? WHERE id=?', (time.time(), user_id))
+            diaries = await self._elschool(self.elschool.get_diaries(jwtoken, url, date))
         else:
-            diaries, url = await elschool.get_diaries_and_url(jwtoken, date)
-            class_id = self._class_id_from_url(url)
-            await cursor.execute('UPDATE users SET schedule_last_cache=?, url=?, class_id=? WHERE id=?',
-                                 (time.time(), url, class_id, user_id))
-        await cursor.execute('DELETE FROM schedule_cache WHERE user_id=?', (user_id,))
+            diaries, url = await self._elschool(self.elschool.get_diaries_and_url(jwtoken, date))
+        class_id = self._class_id_from_url(url)
+
+        year, week = self._week(date)
+        now = time.time()
         data = []
         for day_date, day in diaries.items():
             if day is None:
                 continue
             for lesson in day.values():
-                data.append((user_id, day_date, lesson['number'], lesson['name'],
+                data.append((class_id, year, week, day_date, lesson['number'], lesson['name'],
                              lesson['start_time'], lesson['end_time'], lesson['homework']))
-        await cursor.executemany('INSERT INTO schedule_cache VALUES (?, ?, ?, ?, ?, ?, ?)', data)
-        await self.db.commit()
-        return diaries[date.strftime('%d.%m.%Y')]
+        async with self.db.cursor() as cursor:
+            if user_changed:
+                await cursor.execute('UPDATE users SET url=?, class_id=? WHERE id=?', (url, class_id, user_id))
+            await cursor.execute('DELETE FROM class_schedule_cache WHERE class_id=? AND year=? AND week=?',
+                                 (class_id, year, week))
+            await cursor.execute('DELETE FROM class_schedule_cache WHERE class_id=? AND (year, week) IN '
+                                 '(SELECT year, week FROM class_schedule_weeks WHERE class_id=? AND last_cache<?)',
+                                 (class_id, class_id, now - SCHEDULE_CACHE_LIFETIME))
+            await cursor.execute('DELETE FROM class_schedule_weeks WHERE class_id=? AND last_cache<?',
+                                 (class_id, now - SCHEDULE_CACHE_LIFETIME))
+            await cursor.executemany('INSERT INTO class_schedule_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', data)
+            await cursor.execute('INSERT OR REPLACE INTO class_schedule_weeks VALUES (?, ?, ?, ?)',
+                                 (class_id, year, week, now))
+            await self.db.commit()
+        if user_changed:
+            self.cache.invalidate_user(user_id)
+        return diaries.get(date.strftime('%d.%m.%Y'))
 
     async def add_changes(self, user_id, date: typing.Union[datetime.date, int], changes):
         if isinstance(date, int):
@@ -320,9 +594,7 @@ class Repo:
         await self.db.commit()
 
     async def _add_changes(self, user_id, timestamp, changes):
-        cursor = await self.db.execute('SELECT class_id FROM users WHERE id=?', (user_id,))
-        class_id, = await cursor.fetchone()
-        class_id = await self.check_class_id(class_id, user_id, False)
+        class_id = await self.check_class_id((await self._get_user(user_id))['class_id'], user_id, False)
         data = [(class_id, timestamp, number, lesson.get('name'), lesson.get('start_time'), lesson.get('end_time'),
                  lesson.get('homework'), lesson.get('homework_next'), lesson.get('remove'))
                 for number, lesson in changes.items()]
@@ -345,39 +617,76 @@ class Repo:
             day += datetime.timedelta(days=1)
 
     async def get_user_autosend_schedule(self, user_id):
-        cursor = await self.db.execute(
-            'SELECT autosend_schedule_time, autosend_schedule_interval FROM users WHERE id=?',
-            (user_id,))
-        return await cursor.fetchone()
+        user = await self._get_user(user_id)
+        if user is None:
+            return None
+        return user['autosend_schedule_time'], user['autosend_schedule_interval']
 
     async def set_user_autosend_schedule(self, user_id, time, interval):
         await self.db.execute('UPDATE users SET autosend_schedule_time=?, autosend_schedule_interval=? WHERE id=?',
                               (time, interval, user_id))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
 
     async def get_user_notify_change_schedule(self, user_id):
-        cursor = await self.db.execute('SELECT notify_change_schedule FROM users WHERE id=?',
-                                       (user_id,))
-        return (await cursor.fetchone())[0]
+        return (await self._get_user(user_id))['notify_change_schedule']
 
     async def set_user_notify_change_schedule(self, user_id, notify_change_schedule):
         await self.db.execute('UPDATE users SET notify_change_schedule=? WHERE id=?',
                               (notify_change_schedule, user_id))
         await self.db.commit()
+        self.cache.invalidate_user(user_id)
 
     async def get_class_users_notify_change_schedule(self, user_id):
-        cursor = await self.db.execute('SELECT class_id FROM users WHERE id=?', (user_id,))
-        class_id, = await cursor.fetchone()
-        class_id = await self.check_class_id(class_id, user_id)
+        class_id = await self.check_class_id((await self._get_user(user_id))['class_id'], user_id)
         cursor = await self.db.execute('SELECT id FROM users WHERE class_id=?'
                                        'AND notify_change_schedule',
                                        (class_id,))
         return [i[0] async for i in cursor]
 
 
+class Refresher:
+    """Обновляет кеш в фоне со своим соединением из пула, пока пользователь смотрит сохранённые данные."""
+
+    def __init__(self, pool: ConnectionPool, elschool: 'ElschoolRepo', cache: RepoCache = None):
+        self.pool = pool
+        self.elschool = elschool
+        self.cache = cache
+        self._tasks = {}
+
+    def start(self, key, refresh: typing.Callable[[Repo], typing.Awaitable]) -> asyncio.Task:
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run(refresh))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return task
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def stop(self):
+        """Ждёт обновления, которые уже начались, чтобы они успели сохранить данные до закрытия пула."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def _run(self, refresh):
+        try:
+            async with self.pool.lease() as connection:
+                return await refresh(Repo(connection, self.elschool, cache=self.cache))
+        except Exception:
+            logger.exception('не удалось обновить данные в фоне')
+            return None
+
+
 class RepoMiddleware(BaseMiddleware):
-    def __init__(self, dbfile):
-        self.dbfile = dbfile
+    def __init__(self, pool: ConnectionPool, elschool: 'ElschoolRepo', cache: RepoCache = None,
+                 refresher: Refresher = None):
+        self.pool = pool
+        self.elschool = elschool
+        self.cache = cache
+        self.refresher = refresher or Refresher(pool, elschool, cache)
 
     async def __call__(
             self,
@@ -385,13 +694,17 @@ class RepoMiddleware(BaseMiddleware):
             event: TelegramObject,
             data: typing.Dict[str, typing.Any],
     ) -> typing.Any:
-        async with aiosqlite.connect(self.dbfile) as connection:
-            data['repo'] = Repo(connection)
+        # соединение берётся при первом запросе к базе данных и отдаётся на время запросов к elschool
+        async with self.pool.lease() as connection:
+            data['repo'] = Repo(connection, self.elschool, self.refresher, self.cache)
             return await handler(event, data)
 
 
 def _check_response(response, url, error_message, login=None, password=None):
     logger.debug(f'проверка ответа от сервера: {response}')
+    if response.status in RETRY_STATUSES:
+        raise ServerError(f'{error_message}, проблемы с сервером, код ошибки http {response.status}',
+                          _retry_after(response))
     if not response.ok:
         raise RegisterError(f'{error_message}, проблемы с сервером, код ошибки http {response.status}')
 
@@ -405,203 +718,313 @@ def _check_response(response, url, error_message, login=None, password=None):
                         login, password)
 
 
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', 0))
+    except ValueError:
+        return 0.0
+
+
+def select_quarter(grades, quarter):
+    if not quarter:
+        return grades
+    if quarter not in grades:
+        raise DataProcessError(f'при обработке данных возникла ошибка: {quarter!r}')
+    return grades[quarter]
+
+
+def class_id_from_url(url):
+    return int(url.lower().split('departmentid')[1].split('&')[0][1:])
+
+
 class ElschoolRepo:
+    def __init__(self, config: ElschoolConfig = None):
+        self.config = config or ElschoolConfig()
+        self._session = None
+        self._in_flight = {}
+        self._executor = None
+        self.limiter = RequestLimiter(self.config.rate_limit, self.config.rate_burst, self.config.max_concurrency)
+        self.breaker = CircuitBreaker('elschool', self.config.breaker_failures, self.config.breaker_reset_timeout)
+        self.parser = choose_parser(self.config.html_parser)
+        logger.info(f'для обработки страниц elschool используется парсер {self.parser}')
+        self.retries = 0
+        self.failures = 0
+        self.parses = 0
+        self.parse_time = 0.0
+        self.max_parse_time = 0.0
+        self.pool_restarts = 0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.limit,
+                                             limit_per_host=self.config.limit_per_host,
+                                             keepalive_timeout=self.config.keepalive_timeout,
+                                             ttl_dns_cache=self.config.dns_cache_ttl,
+                                             ssl=False)
+            # куки у каждого пользователя свои, поэтому они передаются в заголовках каждого запроса,
+            # а общая сессия их не запоминает
+            self._session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        return self._session
+
+    @property
+    def executor(self) -> typing.Optional[concurrent.futures.Executor]:
+        if self._executor is None:
+            workers = self.config.parse_workers
+            if self.config.parse_executor == 'process':
+                # fork копирует потоки aiosqlite вместе с их блокировками, поэтому процессы запускаются заново
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('spawn'))
+            elif self.config.parse_executor == 'thread':
+                self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='parse')
+        return self._executor
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _parse(self, parse, *args):
+        """Разбирает страницу в пуле, чтобы цикл событий не останавливался на время разбора."""
+        start = time.monotonic()
+        try:
+            result = await self._run_parse(parse, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # страница могла сама уронить процесс, второй раз пул не пересоздаётся
+            logger.exception('пул разбора страниц снова сломался, страница будет разобрана в цикле событий')
+            result = parse(*args, self.parser)
+        parse_time = time.monotonic() - start
+        self.parses += 1
+        self.parse_time += parse_time
+        self.max_parse_time = max(self.max_parse_time, parse_time)
+        return result
+
+    async def _run_parse(self, parse, *args):
+        for attempt in range(2):
+            executor = self.executor
+            if executor is None:
+                return parse(*args, self.parser)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, parse, *args, self.parser)
+            except concurrent.futures.process.BrokenProcessPool:
+                # процесс пула умер, например его убили из-за нехватки памяти. Пул больше ничего не примет,
+                # поэтому создаётся новый. Другие разборы из того же пула могли уже это сделать
+                if self._executor is executor:
+                    logger.exception('пул разбора страниц сломался, он будет создан заново')
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+                    self.pool_restarts += 1
+                if attempt:
+                    raise
+
+    def stats(self):
+        return {
+            **self.limiter.stats(),
+            **self.breaker.stats(),
+            'повторов запросов': self.retries,
+            'запросов с ошибкой после повторов': self.failures,
+            'разбор страниц': self.config.parse_executor or 'в цикле событий',
+            'пересозданий пула разбора': self.pool_restarts,
+            'разобрано страниц': self.parses,
+            'среднее время разбора, мс': round(self.parse_time / self.parses * 1000, 2) if self.parses else 0,
+            'максимальное время разбора, мс': round(self.max_parse_time * 1000, 2),
+        }
+
+    def _headers(self, jwtoken):
+        return {'Cookie': f'JWToken={jwtoken}'}
+
+    @contextlib.asynccontextmanager
+    async def _request(self, method, url, key, deadline=None, **kwargs):
+        """Запрос к elschool через общий ограничитель. key определяет, чья это очередь.
+        deadline - время по time.monotonic, после которого не ждать ни очереди, ни ответа."""
+        if not self.breaker.allow():
+            raise CircuitOpenError('elschool сейчас не отвечает, попробуй немного позже')
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                await stack.enter_async_context(self.limiter.acquire(key, remaining))
+            except QueueTimeout:
+                self.breaker.record_skipped()
+                raise
+            total = self.config.request_timeout
+            if deadline is not None:
+                # 0 в aiohttp значит без ограничения
+                total = min(total, max(0.01, deadline - time.monotonic()))
+            timeout = aiohttp.ClientTimeout(total=total)
+            async with self.session.request(method, url, timeout=timeout, **kwargs) as response:
+                yield response
+
+    async def _fetch(self, url, headers, error_message, as_bytes=False, login=None, password=None):
+        """GET запрос с проверкой ответа. Временные ошибки повторяются с растущей паузой,
+        пока не кончатся попытки или время на всю операцию."""
+        deadline = time.monotonic() + self.config.operation_timeout
+        attempt = 0
+        while True:
+            try:
+                # у каждого пользователя свой токен, поэтому заголовок с ним и есть ключ очереди
+                async with self._request('GET', url, headers['Cookie'], deadline, headers=headers) as response:
+                    _check_response(response, url, error_message, login, password)
+                    if as_bytes:
+                        body = await response.content.read()
+                    else:
+                        body = await response.text()
+            except CircuitOpenError:
+                raise
+            except QueueTimeout as e:
+                # запрос так и не дошёл до elschool, размыкателю сообщать нечего
+                self.failures += 1
+                raise ServerError(f'{error_message}, слишком много запросов к elschool, '
+                                  f'попробуй немного позже') from e
+            except (ServerError, *RETRY_ERRORS) as e:
+                self.breaker.record_failure()
+                error = e
+            except RegisterError:
+                # сервер ответил, просто не принял токен
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return body
+            retry_after = error.retry_after if isinstance(error, ServerError) else 0.0
+            delay = max(retry_after, random.uniform(0, min(self.config.retry_backoff_max,
+                                                           self.config.retry_backoff * 2 ** attempt)))
+            attempt += 1
+            if attempt > self.config.retries or time.monotonic() + delay >= deadline:
+                self.failures += 1
+                if isinstance(error, ServerError):
+                    raise error
+                raise ServerError(f'{error_message}, сервер не отвечает ({type(error).__name__})') from error
+            self.retries += 1
+            logger.info(f'запрос к {url} не удался ({error!r}), попытка {attempt + 1} через {delay:.1f} с')
+            await asyncio.sleep(delay)
+
+    async def _single_flight(self, key, fetch):
+        """Выполняет запрос, но если такой же запрос уже выполняется, ждёт его результат."""
+        task = self._in_flight.get(key)
+        if task is not None:
+            logger.debug(f'запрос {key} уже выполняется, ждём его результат')
+            try:
+                result = await asyncio.shield(task)
+            except ServerError:
+                # запрос уже повторяли, ещё одна попытка только нагрузит сервер
+                raise
+            except RegisterError:
+                # запрос мог запустить одноклассник, у которого устарел токен, а наш ещё работает
+                return await fetch()
+            return copy.deepcopy(result)
+
+        task = asyncio.ensure_future(fetch())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda done: self._forget_in_flight(key, done))
+        # результат изменяют после получения, поэтому каждому, и тому, кто запустил запрос, достаётся своя копия,
+        # а общий результат остаётся нетронутым
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def _forget_in_flight(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()
+
     async def register(self, login, password):
         logger.debug(f'пользователь с логином {login} получает токен регистрации')
-        async with aiohttp.ClientSession() as session:
-            response = await session.post('https://elschool.ru/Logon/Index',
-                                          params={'login': login, 'password': password}, ssl=False)
-            _check_response(response, 'https://elschool.ru/users/privateoffice',
-                            'не удалось выполнить регистрацию', login, password)
-            jwtoken = session.cookie_jar.filter_cookies('https://elschool.ru').get('JWToken').value
-            logger.debug(f'токен получен {jwtoken}')
-            return jwtoken
+        error_message = 'не удалось выполнить регистрацию'
+        try:
+            async with self._request('POST', 'https://elschool.ru/Logon/Index', login,
+                                     params={'login': login, 'password': password},
+                                     allow_redirects=False) as response:
+                if response.status in RETRY_STATUSES:
+                    raise ServerError(f'{error_message}, проблемы с сервером, код ошибки http {response.status}',
+                                      _retry_after(response))
+                cookie = response.cookies.get('JWToken')
+        except CircuitOpenError:
+            raise
+        except ServerError:
+            # вход не повторяется, но результат, как и в _fetch, сообщается размыкателю,
+            # иначе пробный запрос займёт проверку до конца reset_timeout
+            self.breaker.record_failure()
+            raise
+        except RETRY_ERRORS as e:
+            self.breaker.record_failure()
+            raise ServerError(f'{error_message}, сервер не отвечает ({type(e).__name__})') from e
+        self.breaker.record_success()
+        if cookie is None:
+            raise RegisterError('не удалось выполнить регистрацию, сервер не отправил токен. '
+                                'Обычно такое происходит если не правильно указан логин или пароль.',
+                                login, password)
+        jwtoken = cookie.value
+        await self._fetch('https://elschool.ru/users/privateoffice', self._headers(jwtoken),
+                          error_message, login=login, password=password)
+        logger.debug(f'токен получен {jwtoken}')
+        return jwtoken
 
     async def get_grades(self, jwtoken, url, quarter):
-        async with aiohttp.ClientSession(cookies={'JWToken': jwtoken}) as session:
-            return await self._get_grades(quarter, session, url)
+        grades = await self._single_flight((jwtoken, url, 'grades'),
+                                           lambda: self._get_grades(self._headers(jwtoken), url))
+        return select_quarter(grades, quarter)
 
-    async def _get_grades(self, quarter, session, url):
+    async def _get_grades(self, headers, url):
         logger.info(f'получаем оценки с {url}')
-        response = await session.get(url, ssl=False)
-        _check_response(response, url, 'не удалось получить оценки с сервера')
-        text = await response.text()
-
-        try:
-            bs = BeautifulSoup(text, 'html.parser')
-            table = bs.find('table', class_='GradesTable')
-            if not table:
-                raise DataProcessError('на странице не найдена таблица с оценками')
-            thead = table.find('thead')
-            if not thead:
-                raise DataProcessError('на странице не найден блок для заголовков')
-            ths = thead.find_all('th')
-            if not ths:
-                raise DataProcessError('на странице не найдены заголовки с названиями частей года')
-            quarters = [th.text.strip() for th in ths if not th.attrs]
-            grades = {}
-
-            for i in range(len(quarters)):
-                quarter_grades = {}
-                tbody = table.find('tbody')
-                if not tbody:
-                    raise DataProcessError('на странице не найдено тело таблицы')
-                trs = tbody.find_all('tr')
-                if not trs:
-                    raise DataProcessError('в таблице нет строк с уроками')
-                for tr in trs:
-                    td = tr.find('td', class_='grades-lesson')
-                    if not td:
-                        raise DataProcessError('в строке таблицы нет названия урока')
-                    lesson_name = td.text.strip()
-                    lesson_marks = []
-                    tds = tr.find_all('td', class_='grades-marks')
-                    if not tds:
-                        raise DataProcessError('в строке таблицы нет частей года')
-                    if i >= len(tds):
-                        raise DataProcessError('выбранной части года нет в строке таблицы')
-                    marks = tds[i]
-
-                    for mark in marks.find_all('span', class_='mark-span'):
-                        lesson_date, date = mark['data-popover-content'].split('<p>')
-                        lesson_marks.append({
-                            'lesson_date': lesson_date.split(':')[1].strip(),
-                            'date': date.split(':')[1].strip(),
-                            'mark': int(mark.text)
-                        })
-
-                    quarter_grades[lesson_name] = lesson_marks
-                grades[quarters[i]] = quarter_grades
-
-            if quarter:
-                return grades[quarter]
-        except Exception as e:
-            raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
-        return grades
+        text = await self._fetch(url, headers, 'не удалось получить оценки с сервера')
+        return await self._parse(parse_grades, text)
 
-    async def _get_results_grades(self, session, url: str):
+    async def _get_results_grades(self, headers, url: str):
         url = url.replace('grades', 'results')
         logger.info(f'получаем итоговые оценки с {url}')
-        response = await session.get(url, ssl=False)
-        _check_response(response, url, 'не удалось получить оценки с сервера')
-        text = await response.text()
-
-        try:
-            bs = BeautifulSoup(text, 'html.parser')
-            table = bs.find('table', class_='ResultsTable')
-            if not table:
-                raise DataProcessError('на странице не найдена таблица с оценками')
-            thead = table.find('thead')
-            if not thead:
-                raise DataProcessError('на странице не найден блок для заголовков')
-            ths = thead.find_all('th')
-            if not ths:
-                raise DataProcessError('на странице не найдены заголовки с названиями частей года')
-            quarters = [th.text.strip() for th in ths if not th.attrs][1:]
-            results = {}
-            tbody = table.find('tbody')
-            if not tbody:
-                raise DataProcessError('на странице не найдено тело таблицы')
-            trs = tbody.find_all('tr')
-            if not trs:
-                raise DataProcessError('в таблице нет строк с уроками')
-            for tr in trs:
-                lesson = tr.find('td').text.strip()
-                lesson_results = {}
-                for quarter, td in zip(quarters, tr.find_all('td', class_='results-mark')):
-                    text = td.text.strip()
-                    if not text:
-                        lesson_results[quarter] = None
-                    else:
-                        lesson_results[quarter] = int(text)
-                results[lesson] = lesson_results
-            return results
-        except Exception as e:
-            raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
+        text = await self._fetch(url, headers, 'не удалось получить оценки с сервера')
+        return await self._parse(parse_results, text)
 
     async def get_results_and_url(self, jwtoken):
-        async with aiohttp.ClientSession(cookies={'JWToken': jwtoken}) as session:
-            url = await self._get_url(session)
-            grades = await self._get_results_grades(session, url)
+        return await self._single_flight((jwtoken, None, 'results'), lambda: self._get_results_and_url(jwtoken))
+
+    async def _get_results_and_url(self, jwtoken):
+        headers = self._headers(jwtoken)
+        url = await self._get_url(headers)
+        grades = await self._get_results_grades(headers, url)
         return grades, url
 
     async def get_results(self, jwtoken, url):
-        async with aiohttp.ClientSession(cookies={'JWToken': jwtoken}) as session:
-            grades = await self._get_results_grades(session, url)
-        return grades
+        return await self._single_flight((jwtoken, url, 'results'),
+                                         lambda: self._get_results_grades(self._headers(jwtoken), url))
 
     async def get_grades_and_url(self, jwtoken, quarter=None):
-        async with aiohttp.ClientSession(cookies={'JWToken': jwtoken}) as session:
-            url = await self._get_url(session)
-            grades = await self._get_grades(quarter, session, url)
+        grades, url = await self._single_flight((jwtoken, None, 'grades'), lambda: self._get_grades_and_url(jwtoken))
+        return select_quarter(grades, quarter), url
+
+    async def _get_grades_and_url(self, jwtoken):
+        headers = self._headers(jwtoken)
+        url = await self._get_url(headers)
+        grades = await self._get_grades(headers, url)
         return grades, url
 
-    async def _get_url(self, session):
-        response = await session.get(f'https://elschool.ru/users/diaries', ssl=False)
-        _check_response(response, 'https://elschool.ru/users/diaries',
-                        'при получении ссылки на страницу с оценками произошла ошибка')
-        html = await response.text()
-        bs = BeautifulSoup(html, 'html.parser')
-        a = bs.find('a', text='Табель')
-        if not a:
-            raise DataProcessError('на странице дневника не найдена ссылка на страницу с оценками')
-        return 'https://elschool.ru/users/diaries/' + a['href']
-
-    async def _get_diaries(self, session: aiohttp.ClientSession, url, date):
-        url = url.replace('grades', 'details') + f'&year={date.year}&week={date.isocalendar()[1]}'
-        response = await session.get(url, ssl=False)
-        _check_response(response, url, 'не удалось получить расписание с сервера')
-        text = await response.content.read()
-        try:
-            bs = BeautifulSoup(text, 'html.parser')
-            days = {}
-            for div in bs.find('div', class_='diaries').find_all('div'):
-                table = div.find('table', class_='table')
-                if table is None:
-                    continue
-                for tbody in table.find_all('tbody'):
-                    trs = tbody.find_all('tr', class_='diary__lesson')
-                    if not trs:
-                        continue
-                    day = trs[0].find('td', class_='diary__dayweek').text.strip()
-                    if '\xa0' in day:
-                        day = day.split('\xa0', 1)[1].strip()
-                    else:
-                        day = day.split(' ', 1)[1]
-                    day = f'{day}.{date.year}'
-                    if len(trs) == 1 and trs[0].find('td', class_='diary__nolesson') is not None:
-                        days[day] = None
-                        continue
-                    lessons = {}
-                    for tr in trs:
-                        td_discipline = tr.find('td', class_='diary__discipline')
-                        number, name = td_discipline.find('div', class_='flex-grow-1').text.split('. ', 1)
-                        number = int(number)
-                        start_time, end_time = (td_discipline.find('div', class_='diary__discipline__time')
-                                                .text.split('-'))
-                        homework = (tr.find('td', class_='diary__homework')
-                                    .find('div', class_='diary__homework-text').text.strip())
-                        lessons[number] = {
-                            'number': number,
-                            'name': name,
-                            'start_time': start_time.strip(),
-                            'end_time': end_time.strip(),
-                            'homework': homework,
-                        }
-                    days[day] = lessons
-            return days
-        except Exception as e:
-            raise DataProcessError(f'при обработке данных возникла ошибка: {e}') from e
+    async def _get_url(self, headers):
+        html = await self._fetch('https://elschool.ru/users/diaries', headers,
+                                 'при получении ссылки на страницу с оценками произошла ошибка')
+        return await self._parse(parse_url, html)
+
+    async def _get_diaries(self, headers, url, date):
+        # неделя и её год по ISO, как и в ключах кеша: 30.12.2024 это первая неделя 2025 года
+        year, week = date.isocalendar()[:2]
+        url = url.replace('grades', 'details') + f'&year={year}&week={week}'
+        text = await self._fetch(url, headers, 'не удалось получить расписание с сервера', as_bytes=True)
+        return await self._parse(parse_diaries, text, year, week)
 
     async def get_diaries(self, jwtoken, url, date):
-        async with aiohttp.ClientSession(cookies={'JWToken': jwtoken}) as session:
-            diaries = await self._get_diaries(session, url, date)
-        return diaries
+        # расписание одинаковое для всего класса, поэтому одноклассники ждут один и тот же запрос
+        key = (class_id_from_url(url), *date.isocalendar()[:2], 'diaries')
+        return await self._single_flight(key, lambda: self._get_diaries(self._headers(jwtoken), url, date))
 
     async def get_diaries_and_url(self, jwtoken, date):
-        async with aiohttp.ClientSession(cookies={'JWToken': jwtoken}) as session:
-            url = await self._get_url(session)
-            diaries = await self._get_diaries(session, url, date)
+        key = (jwtoken, None, *date.isocalendar()[:2], 'diaries')
+        return await self._single_flight(key, lambda: self._get_diaries_and_url(jwtoken, date))
+
+    async def _get_diaries_and_url(self, jwtoken, date):
+        headers = self._headers(jwtoken)
+        url = await self._get_url(headers)
+        diaries = await self._get_diaries(headers, url, date)
         return diaries, url
 
 
@@ -669,6 +1092,17 @@ class RandomRepo:
         return await self.get_grades(jwtoken, url, quarter), url
 
 
+@dataclasses.dataclass
+class GradesDiff:
+    """Изменения в оценках после обновления кеша. Формат такой же как у оценок за все части года:
+    часть года, название урока и список оценок."""
+    added: dict
+    removed: dict
+
+    def __bool__(self):
+        return bool(self.added or self.removed)
+
+
 class RegisterError(Exception):
     def __init__(self, message, login=None, password=None):
         super().__init__(message)
@@ -676,5 +1110,13 @@ class RegisterError(Exception):
         self.password = password
 
 
-class DataProcessError(Exception):
-    pass
+class ServerError(RegisterError):
+    """Временная ошибка elschool, после которой запрос можно повторить."""
+
+    def __init__(self, message, retry_after=0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(ServerError):
+    """elschool недавно перестал отвечать, поэтому запрос даже не отправлялся."""
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from elschool_bot import TelegramConfig
+from elschool_bot.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+LANE_NAMES = ('ответы', 'рассылки')
+
+_priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def bulk():
+    """Сообщения, отправленные внутри, ждут, пока не отправятся ответы пользователям, которые сейчас что-то нажимают.
+    Действует и на задачи, созданные внутри."""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class SendQueue(BaseRequestMiddleware):
+    """Очередь всех запросов к telegram, которые что-то делают в чате.
+
+    Пропускает не больше rate запросов в секунду всего и chat_rate в каждый чат, поэтому telegram
+    не отвечает ошибкой 429. Если всё же ответил, запрос повторяется через столько секунд, сколько он просит.
+    Рассылки ждут, пока не отправятся ответы, поэтому не замедляют бота для тех, кто им пользуется.
+    """
+
+    def __init__(self, config: TelegramConfig = None):
+        self.config = config or TelegramConfig()
+        self.bucket = TokenBucket(self.config.rate, self.config.burst)
+        # id чата -> его ограничение. Полное ничем не отличается от нового, такие иногда удаляются
+        self._chats = {}
+        self._chats_limit = 1024
+        # очереди по приоритету: (future, id чата)
+        self._lanes = tuple(collections.deque() for _ in LANE_NAMES)
+        self._timer = None
+        self.sent = [0] * len(LANE_NAMES)
+        self.wait_time = [0.0] * len(LANE_NAMES)
+        self.max_wait_time = [0.0] * len(LANE_NAMES)
+        self.max_queue_size = 0
+        self.retries = 0
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        # getUpdates, ответы на нажатия кнопок и прочее, что не пишет в чат, не ограничивается
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority = _priority.get()
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.config.retries:
+                    raise
+                self.retries += 1
+                logger.warning(f'telegram просит подождать {e.retry_after} с перед запросом {method.__api_method__} '
+                               f'в чат с id {chat_id}')
+                self._chat(chat_id).pause(e.retry_after)
+
+    def queue_size(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def _chat(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._chats_limit:
+                self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items() if not bucket.full()}
+                self._chats_limit = max(1024, 2 * len(self._chats))
+            bucket = self._chats[chat_id] = TokenBucket(self.config.chat_rate, self.config.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, chat_id)
+        lane = self._lanes[priority]
+        lane.append(entry)
+        self.max_queue_size = max(self.max_queue_size, self.queue_size())
+        self._dispatch()
+        if not future.done():
+            try:
+                await future
+            except asyncio.CancelledError:
+                with contextlib.suppress(ValueError):
+                    lane.remove(entry)
+                raise
+        wait_time = time.monotonic() - start
+        self.sent[priority] += 1
+        self.wait_time[priority] += wait_time
+        self.max_wait_time[priority] = max(self.max_wait_time[priority], wait_time)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        delay = None
+        exhausted = False
+        for lane in self._lanes:
+            waiting = []
+            while lane:
+                entry = lane.popleft()
+                future, chat_id = entry
+                if future.done():
+                    continue
+                if exhausted:
+                    waiting.append(entry)
+                    continue
+                chat = self._chat(chat_id)
+                chat_delay = chat.delay()
+                if chat_delay > 0:
+                    # этот чат ждёт, но запросы в другие чаты можно пропустить
+                    waiting.append(entry)
+                    delay = chat_delay if delay is None else min(delay, chat_delay)
+                    continue
+                if not self.bucket.take():
+                    # разрешения кончились, ждут все, в том числе очереди с меньшим приоритетом
+                    exhausted = True
+                    waiting.append(entry)
+                    delay = self.bucket.delay() if delay is None else min(delay, self.bucket.delay())
+                    continue
+                chat.take()
+                future.set_result(None)
+            lane.extend(waiting)
+        if delay is not None:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def stats(self):
+        stats = {
+            'в очереди': self.queue_size(),
+            'максимальная очередь': self.max_queue_size,
+            'повторов после 429': self.retries,
+        }
+        for i, name in enumerate(LANE_NAMES):
+            sent = self.sent[i]
+            stats[f'{name}, в очереди'] = len(self._lanes[i])
+            stats[f'{name}, отправлено'] = sent
+            stats[f'{name}, среднее ожидание, мс'] = round(self.wait_time[i] / sent * 1000, 2) if sent else 0
+            stats[f'{name}, максимальное ожидание, мс'] = round(self.max_wait_time[i] * 1000, 2)
+        return stats
@@ -1,6 +1,12 @@
+import asyncio
+
 from aiogram_dialog import Window, DialogManager
 from aiogram_dialog.widgets.text import Format
 
+# ссылки на задачи обновления, чтобы их не удалил сборщик мусора.
+# Создаётся до функции set ниже, которая перекрывает встроенную
+_updates = set()
+
 
 def create(state, *widgets):
     return Window(create_status_widget(), *widgets, state=state)
@@ -17,3 +23,17 @@ def set(manager: DialogManager, status: str, **data):
 
 async def update(manager: DialogManager, status: str, show_mode=None, **data):
     await manager.update({'status': status, **data}, show_mode=show_mode)
+
+
+def update_when_refreshed(manager: DialogManager, refreshing: asyncio.Task, make_data):
+    """Когда фоновое обновление вернёт новые данные, обновляет ими этот диалог, если он ещё открыт."""
+    bg = manager.bg()
+
+    async def update():
+        result = await refreshing
+        if result is not None:
+            await bg.update(make_data(result))
+
+    task = asyncio.create_task(update())
+    _updates.add(task)
+    task.add_done_callback(_updates.discard)
@@ -0,0 +1,59 @@
+import pathlib
+
+import pytest
+
+from elschool_bot.parsing import available_parsers, parse_diaries, parse_grades, parse_results, parse_url
+
+PAGES = pathlib.Path(__file__).parent.parent / 'db' / 'pages'
+
+needs_lxml = pytest.mark.skipif('lxml' not in available_parsers(), reason='lxml не установлен')
+
+
+def page(name):
+    return (PAGES / name).read_text(encoding='utf-8')
+
+
+def test_grades():
+    grades = parse_grades(page('grades.html'), 'html.parser')
+    assert list(grades) == ['1 четверть', '2 четверть', '3 четверть', '4 четверть']
+    assert len(grades['1 четверть']) == 15
+    assert grades['1 четверть']['Алгебра'][0] == {'lesson_date': '13.09.2023', 'date': '14.09.2023', 'mark': 5}
+    assert grades['1 четверть']['Индивидуальный проект'] == []
+    assert grades['4 четверть']['Алгебра'] == []
+
+
+def test_results():
+    results = parse_results(page('results.html'), 'html.parser')
+    assert len(results) == 15
+    assert results['Алгебра'] == {'1 четверть': 4, '2 четверть': 4, '3 четверть': None, '4 четверть': None}
+
+
+def test_diaries():
+    text = page('diaries.html')
+    diaries = parse_diaries(text, 2024, 3, 'html.parser')
+    assert list(diaries) == ['15.01.2024', '16.01.2024', '17.01.2024', '18.01.2024', '19.01.2024', '20.01.2024']
+    assert diaries['15.01.2024'][4] == {'number': 4, 'name': 'Русский язык', 'start_time': '10:40',
+                                        'end_time': '11:20', 'homework': 'стр. 54 & 55'}
+    # в субботу уроков нет
+    assert diaries['20.01.2024'] is None
+    assert parse_url(text, 'html.parser') == ('https://elschool.ru/users/diaries/'
+                                              'grades?rooId=1&instituteId=2&departmentId=345&pupilId=6')
+
+
+@needs_lxml
+def test_grades_same_with_both_parsers():
+    text = page('grades.html')
+    assert parse_grades(text, 'lxml') == parse_grades(text, 'html.parser')
+
+
+@needs_lxml
+def test_results_same_with_both_parsers():
+    text = page('results.html')
+    assert parse_results(text, 'lxml') == parse_results(text, 'html.parser')
+
+
+@needs_lxml
+def test_diaries_same_with_both_parsers():
+    text = page('diaries.html')
+    assert parse_diaries(text, 2024, 3, 'lxml') == parse_diaries(text, 2024, 3, 'html.parser')
+    assert parse_url(text, 'lxml') == parse_url(text, 'html.parser')
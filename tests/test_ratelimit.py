@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from elschool_bot.ratelimit import QueueTimeout, RequestLimiter
+
+
+def test_cancel_waiter_during_release():
+    async def main():
+        limiter = RequestLimiter(None, 1, 1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.acquire('a'):
+                await release.wait()
+
+        async def wait():
+            async with limiter.acquire('b'):
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(wait())
+        await asyncio.sleep(0)
+        assert limiter.queue_size() == 1
+
+        # ожидающий запрос отменяется в том же шаге, в котором освобождается место
+        release.set()
+        waiter.cancel()
+        await asyncio.gather(holder, waiter, return_exceptions=True)
+
+        assert limiter.active == 0
+        assert limiter.queue_size() == 0
+        async with limiter.acquire('c'):
+            assert limiter.active == 1
+        assert limiter.active == 0
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+
+def test_acquire_timeout():
+    async def main():
+        limiter = RequestLimiter(None, 1, 1)
+        async with limiter.acquire('a'):
+            with pytest.raises(QueueTimeout):
+                async with limiter.acquire('b', 0.05):
+                    pass
+            assert limiter.queue_size() == 0
+        assert limiter.active == 0
+        async with limiter.acquire('c', 0.05):
+            assert limiter.active == 1
+
+    asyncio.run(asyncio.wait_for(main(), 5))
@@ -0,0 +1,74 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+
+from elschool_bot import DatabaseConfig, ElschoolConfig
+from elschool_bot.database import connect
+from elschool_bot.migrations import Migrator
+from elschool_bot.repository import ElschoolRepo, Repo, ServerError
+
+URL = 'https://elschool.ru/users/diaries/grades?rooId=1&instituteId=2&departmentId=345&pupilId=6'
+
+
+def diaries_page(days):
+    tbodies = ''
+    for day in days:
+        tbodies += ('<tbody><tr class="diary__lesson">'
+                    f'<td class="diary__dayweek"><p>Пн\xa0{day}</p></td>'
+                    '<td class="diary__discipline"><div class="flex-grow-1">1. Алгебра</div>'
+                    '<div class="diary__discipline__time">08:00 - 08:40</div></td>'
+                    f'<td class="diary__homework"><div class="diary__homework-text">дз {day}</div></td>'
+                    '</tr></tbody>')
+    return f'<div class="diaries"><div><table class="table">{tbodies}</table></div></div>'.encode()
+
+
+def test_diaries_week_across_new_year(tmp_path):
+    async def main():
+        dbfile = str(tmp_path / 'bot.db')
+        await Migrator(dbfile, DatabaseConfig()).migrate()
+        elschool = ElschoolRepo(ElschoolConfig(parse_executor=None))
+        urls = []
+
+        async def fetch(url, headers, error_message, as_bytes=False, login=None, password=None):
+            urls.append(url)
+            return diaries_page(('30.12', '31.12', '01.01', '02.01', '03.01'))
+
+        elschool._fetch = fetch
+        connection = await connect(dbfile, DatabaseConfig())
+        try:
+            repo = Repo(connection, elschool)
+            await repo.register_user(1, 'token', URL, '1 четверть')
+            december = await repo.get_diaries(1, datetime.date(2024, 12, 30))
+            january = await repo.get_diaries(1, datetime.date(2025, 1, 2))
+        finally:
+            await connection.close()
+            await elschool.close()
+        return urls, december, january
+
+    urls, december, january = asyncio.run(main())
+    # обе даты в первой неделе 2025 года по ISO, поэтому страница запрашивается один раз
+    assert urls == [URL.replace('grades', 'details') + '&year=2025&week=1']
+    assert december[1]['homework'] == 'дз 30.12'
+    assert january[1]['homework'] == 'дз 02.01'
+
+
+def test_fetch_does_not_wait_in_queue_past_operation_timeout():
+    async def main():
+        elschool = ElschoolRepo(ElschoolConfig(parse_executor=None, max_concurrency=1, operation_timeout=0.2))
+        try:
+            # место занято чужим запросом, который не закончится раньше времени на операцию
+            async with elschool.limiter.acquire('other'):
+                start = time.monotonic()
+                with pytest.raises(ServerError):
+                    await elschool._fetch(URL, elschool._headers('token'), 'не удалось получить оценки')
+                elapsed = time.monotonic() - start
+        finally:
+            await elschool.close()
+        return elapsed, elschool.breaker.failures
+
+    elapsed, failures = asyncio.run(main())
+    assert elapsed < 1
+    # запрос не дошёл до elschool, это не ошибка сервера
+    assert failures == 0